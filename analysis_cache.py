@@ -0,0 +1,119 @@
+import os
+from cache import SqliteCache, make_cache_key
+from image_prep import hash_distance, is_distinctive_hash, thumbnail_distance
+
+# 画像解析結果（キャプション・ラベル・翻訳済みの名詞・テーマ）のキャッシュ
+# 同じファイルは内容のSHA-256で、撮り直した同じ絵は知覚ハッシュの近さで見つける
+# 別の絵の解析結果（他の家庭の絵のキャプションなど）を返さないよう、知覚ハッシュが近くても
+# 色の縮小画像が一致しなければ同じ絵とみなさない
+
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("EHON_ANALYSIS_CACHE_MAX_ENTRIES", "5000"))
+ANALYSIS_CACHE_TTL = int(os.getenv("EHON_ANALYSIS_CACHE_TTL", str(30 * 24 * 60 * 60)))  # 秒
+# 知覚ハッシュ（64ビット）の異なるビット数がこれ以下で、
+PHASH_MAX_DISTANCE = int(os.getenv("EHON_PHASH_MAX_DISTANCE", "3"))
+# 色の縮小画像の違い（画素ごとの差の平均、0〜255）がこれ以下なら同じ絵とみなす
+THUMBNAIL_MAX_DISTANCE = float(os.getenv("EHON_THUMBNAIL_MAX_DISTANCE", "12"))
+# 知覚ハッシュの区間の値ごとに保持する候補の数
+PHASH_BAND_MAX_CANDIDATES = 32
+
+# 解析処理を変えたときは上げる（古い結果を使わないようにする）
+ANALYSIS_VERSION = 1
+
+ANALYSIS_FIELDS = ("caption", "labels", "nouns", "themes")
+
+# SHA-256 → 解析結果
+analysis_cache = SqliteCache(
+    "image_analysis",
+    ttl=ANALYSIS_CACHE_TTL,
+    max_entries=ANALYSIS_CACHE_MAX_ENTRIES
+)
+# 知覚ハッシュ → {"sha256", "thumbnail"}
+phash_index = SqliteCache(
+    "image_phash",
+    ttl=ANALYSIS_CACHE_TTL,
+    max_entries=ANALYSIS_CACHE_MAX_ENTRIES
+)
+# 知覚ハッシュの区間の値 → その値を持つ知覚ハッシュのリスト
+# ハッシュを (PHASH_MAX_DISTANCE + 1) 個の区間に分けると、しきい値以内のハッシュは
+# 少なくとも1つの区間が完全に一致するので、全件を調べずに候補を絞り込める
+phash_bands = SqliteCache(
+    "image_phash_bands",
+    ttl=ANALYSIS_CACHE_TTL,
+    max_entries=ANALYSIS_CACHE_MAX_ENTRIES * (PHASH_MAX_DISTANCE + 1)
+)
+
+def _analysis_key(sha256):
+    return make_cache_key("analysis", ANALYSIS_VERSION, sha256)
+
+def _band_keys(phash):
+    count = PHASH_MAX_DISTANCE + 1
+    return [
+        make_cache_key("band", count, i, phash[i * len(phash) // count:(i + 1) * len(phash) // count])
+        for i in range(count)
+    ]
+
+# 知覚ハッシュと色の縮小画像の両方が近い登録済みの画像のSHA-256（見つからなければ None）
+def _find_similar(phash, thumbnail):
+    candidates = {candidate for key in _band_keys(phash) for candidate in phash_bands.get(key, [])}
+    best_sha256, best_distance = None, PHASH_MAX_DISTANCE + 1
+    for candidate in candidates:
+        distance = hash_distance(phash, candidate)
+        if distance >= best_distance:
+            continue
+        entry = phash_index.get(candidate)
+        if not isinstance(entry, dict):
+            continue
+        if thumbnail_distance(thumbnail, entry["thumbnail"]) <= THUMBNAIL_MAX_DISTANCE:
+            best_sha256, best_distance = entry["sha256"], distance
+    return best_sha256
+
+# 前処理済みの画像（image_prep.preprocess_upload の戻り値）に対する解析結果を取得
+# 見つからなければ None（キャッシュが読めない場合も None）
+def get_analysis(prepared_image):
+    try:
+        return _get_analysis(prepared_image)
+    except Exception as e:
+        print(f"Warning: Failed to read image analysis cache: {e}")
+        return None
+
+def _get_analysis(prepared_image):
+    result = analysis_cache.get(_analysis_key(prepared_image["sha256"]))
+    if result is not None:
+        return result
+
+    phash = prepared_image.get("phash")
+    thumbnail = prepared_image.get("thumbnail")
+    if not phash or not thumbnail or not is_distinctive_hash(phash):
+        return None
+    similar = _find_similar(phash, thumbnail)
+    if similar is None:
+        return None
+    result = analysis_cache.get(_analysis_key(similar))
+    if result is not None:
+        # 次回からは内容のハッシュだけで見つかるようにする
+        analysis_cache.set(_analysis_key(prepared_image["sha256"]), result)
+    return result
+
+# 解析結果を保存する（保存に失敗しても解析結果は使えるので、警告を出すだけにする）
+def store_analysis(prepared_image, results):
+    try:
+        _store_analysis(prepared_image, results)
+    except Exception as e:
+        print(f"Warning: Failed to store image analysis: {e}")
+
+def _store_analysis(prepared_image, results):
+    analysis_cache.set(
+        _analysis_key(prepared_image["sha256"]),
+        {field: results[field] for field in ANALYSIS_FIELDS}
+    )
+    phash = prepared_image.get("phash")
+    thumbnail = prepared_image.get("thumbnail")
+    if not phash or not thumbnail or not is_distinctive_hash(phash):
+        return
+    phash_index.set(phash, {"sha256": prepared_image["sha256"], "thumbnail": thumbnail})
+    for key in _band_keys(phash):
+        candidates = [candidate for candidate in phash_bands.get(key, []) if candidate != phash]
+        phash_bands.set(key, ([phash] + candidates)[:PHASH_BAND_MAX_CANDIDATES])
+
+def cache_stats():
+    return analysis_cache.stats()
@@ -2,27 +2,21 @@ import streamlit as st
 import pandas as pd
 import random
 import base64
-import re
 from pathlib import Path
 import zipfile
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
 import os
-from story import generate_full_story_and_images
+from story import iter_story_and_images, get_image_source
 import time  # ロード中の遅延をシミュレート
-from PIL import Image
-import openai
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from google.cloud import vision
-from deep_translator import GoogleTranslator
-import spacy
-import io
-import gspread
-from google.oauth2.service_account import Credentials
-
-# ZIPファイルを解凍
-model_path = "./en_core_web_sm"
-nlp = spacy.load(model_path)
+from llm import chat_completion
+import captioning
+from captioning import generate_caption
+import text_analysis
+import google_clients
+from vision_labels import extract_labels
+from image_prep import preprocess_upload, image_fingerprint, open_image
+from stage_graph import StageGraph
+from storage import get_storage, STORY_ELEMENT_FIELDS
+import analysis_cache
 
 
 # 必要な環境変数を取得
@@ -42,43 +36,16 @@ SERVICE_ACCOUNT_INFO = {
     "token_uri": "https://oauth2.googleapis.com/token",
 }
 
-# Google Sheets API設定
-RANGE_NAME = "DB!A:G"
-
-# Ehon ID Automatic Generation Logic
-def generate_next_book_id(worksheet):
-    """
-    スプレッドシート内の既存の絵本IDから最大値を取得し、次のIDを生成する
-    """
-    all_rows = worksheet.get_all_values()
-
-    # Ehon-XXXXX形式のIDだけを抽出
-    book_ids = [row[0] for row in all_rows if re.match(r"Ehon-\d{5}", row[0])]
-
-    if not book_ids:
-        # 初回のID生成時
-        return "Ehon-00001"
-
-    # 数字部分だけを抽出して最大値を計算
-    max_id = max(int(book_id.split("-")[1]) for book_id in book_ids)
-    next_id = f"Ehon-{max_id + 1:05d}"
-
-    return next_id
-
+# 絵本データの保存先（Google スプレッドシート、または EHON_STORAGE_BACKEND=sqlite でローカルのSQLite）
+storage = get_storage(SERVICE_ACCOUNT_INFO, SPREADSHEET_ID)
 
 # スプレッドシートからデータを取得する関数
 def fetch_data_from_google_sheets():
     """
-    Google Sheets APIを使用してスプレッドシートからデータを取得。
-    サービスアカウントを使用して認証。
+    保存先（既定ではGoogle スプレッドシートのDBタブ）からプロンプトのデータを取得。
     """
     try:
-        credentials = Credentials.from_service_account_info(SERVICE_ACCOUNT_INFO)
-        service = build("sheets", "v4", credentials=credentials)
-        sheet = service.spreadsheets()
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-        rows = result.get("values", [])
-        return rows[1:] if len(rows) > 1 else []  # ヘッダーを除外
+        return storage.get_prompt_rows()
     except Exception as e:
         st.error(f"スプレッドシートからデータを取得する際にエラーが発生しました: {str(e)}")
         return []
@@ -118,64 +85,41 @@ def upload_image():
     uploaded_file = st.file_uploader("画像をアップロードしてください", type=["jpg", "jpeg", "png"])
     
     if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="アップロードされた画像", use_container_width=True)
+        file_bytes = uploaded_file.getvalue()
+
+        # 前処理（向き補正・表示用・モデル入力用・送信用）はアップロードされた画像ごとに1回だけ行う
+        prepared_image = st.session_state.get("uploaded_image")
+        if not prepared_image or prepared_image["sha256"] != image_fingerprint(file_bytes):
+            prepared_image = preprocess_upload(file_bytes)
+
+        st.image(prepared_image["display"], caption="アップロードされた画像", use_container_width=True)
         st.success("画像が正常にアップロードされました！")
-        return image
+        return prepared_image
     
     return None
 
 # Step2 画像解析に使う関数（3つ）　※画像の要素を抽出
 # Step2−1 BLIPでキャプションを生成する間数
-def generate_caption_blip(image): 
-
-    # BLIPの準備
-    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-    model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-
-    # 画像を処理してキャプションを生成
-    inputs = processor(image, return_tensors="pt")
-    outputs = model.generate(**inputs)
-    caption = processor.decode(outputs[0], skip_special_tokens=True)
-
-    return caption
+# （BLIPモデルはプロセス内で1回だけロードしたものを使い回す）
+# image: preprocess_upload で作成したモデル入力用の画像（バイト列）
+def generate_caption_blip(image_bytes): 
+    return generate_caption(open_image(image_bytes))
 # Step2-2 VisionAIで画像のラベルを取得する関数（スコア0.8以上）
-def extract_labels_visionai(image): 
-    
-    credentials = Credentials.from_service_account_info(SERVICE_ACCOUNT_INFO)
-
-    # Vision AIの準備
-    client = vision.ImageAnnotatorClient(credentials=credentials)
-
-    # PIL画像をバイナリデータに変換
-    image_byte_array = io.BytesIO()
-    image.save(image_byte_array, format="PNG")
-    content = image_byte_array.getvalue()
-
-    # Vision AIリクエストの作成
-    image = vision.Image(content=content)
-    response = client.label_detection(image=image)
-
-    # スコアが0.8以上のラベルを抽出
-    labels = [label.description for label in response.label_annotations if label.score >= 0.8]
-
-    return labels
+# image_bytes: preprocess_upload で作成した送信用の画像（縮小したJPEG、小さければ元ファイル）
+def extract_labels_visionai(image_bytes): 
+    # Vision AIクライアントはプロセス内で使い回す
+    return extract_labels(image_bytes, SERVICE_ACCOUNT_INFO)
 # Step2-3 キャプションから名詞のみを取得し、ラベルと結合。その後日本語へ翻訳する関数
 def extract_nouns(caption, labels, target_language="ja"): 
     
-    # spaCyモデルをロード
-    nlp = spacy.load("en_core_web_sm")
-
-    # キャプションを解析して名詞を抽出
-    doc = nlp(caption)
-    nouns = [token.text for token in doc if token.pos_ == "NOUN"]
+    # キャプションを解析して名詞を抽出（品詞タグ付けだけの軽量なspaCyパイプラインを使用）
+    nouns = text_analysis.extract_nouns_batch([caption])[0]
 
     # 名詞とラベルを結合し、重複を排除
     combined_list = list(set(nouns + labels))
 
-    # 翻訳
-    translator = GoogleTranslator(source="auto", target=target_language)
-    translated_list = [translator.translate(word) for word in combined_list]
+    # 翻訳（用語辞書・キャッシュにない単語だけをまとめて翻訳）
+    translated_list = text_analysis.translate_terms(combined_list, target_language)
 
     return translated_list
 
@@ -197,16 +141,47 @@ def generate_themes(elements):
     - 「心をつなぐ笑顔」
     - 「アートで冒険」
     """
-    response = openai.chat.completions.create(
+    content = chat_completion(
         model="gpt-4o",
         messages=[{"role": "user", "content": prompt}],
         max_tokens=100
     )
     # GPTの応答を整形してリスト化
-    themes_text = response.choices[0].message.content.strip()
+    themes_text = content.strip()
     themes = themes_text.split("\n")
     return [theme.strip("- ").strip() for theme in themes if theme.strip()]
 
+# Step2〜3 の画像解析をまとめて開始する関数
+# キャプション生成とラベル抽出は互いに独立しているので並行して実行し、
+# 両方が終わったら名詞抽出・翻訳 → テーマ生成の順に進める
+# 同じ絵（撮り直したものを含む）の解析結果がキャッシュにあれば、それをそのまま返す
+def start_image_analysis(prepared_image):
+    cached = analysis_cache.get_analysis(prepared_image)
+    if cached is not None:
+        graph = StageGraph()
+        for field in analysis_cache.ANALYSIS_FIELDS:
+            graph.add(field, lambda value=cached[field]: value)
+        return graph.start()
+
+    graph = StageGraph()
+    graph.add("caption", lambda: generate_caption_blip(prepared_image["model"]))
+    graph.add("labels", lambda: extract_labels_visionai(prepared_image["transport"]))
+    graph.add(
+        "nouns",
+        lambda caption, labels: extract_nouns(caption, labels, target_language="ja"),
+        depends_on=["caption", "labels"]
+    )
+    graph.add("themes", lambda nouns: generate_themes(nouns), depends_on=["nouns"])
+    graph.add(
+        "store",
+        lambda caption, labels, nouns, themes: analysis_cache.store_analysis(
+            prepared_image,
+            {"caption": caption, "labels": labels, "nouns": nouns, "themes": themes}
+        ),
+        depends_on=["caption", "labels", "nouns", "themes"]
+    )
+    return graph.start()
+
 # Step4 深掘り質問を生成する関数(画像要素と選択したテーマを基に生成する)
 def generate_deep_questions(selected_theme, nouns):
     
@@ -231,7 +206,7 @@ def generate_deep_questions(selected_theme, nouns):
 
     # 1つの問いかけを生成してください。
     """
-    response = openai.chat.completions.create(
+    content = chat_completion(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "あなたは創造的な絵本のアイデアを生成するプロフェッショナルです。"},
@@ -239,8 +214,7 @@ def generate_deep_questions(selected_theme, nouns):
         ]
     )
 
-    # ChatCompletion の戻り値を正しく参照
-    questions_text = response.choices[0].message.content.strip()
+    questions_text = content.strip()
     questions = questions_text.split("\n")
     return [q.strip("- ").strip() for q in questions if q.strip()]
 
@@ -279,7 +253,7 @@ def story_elements(selected_theme, nouns, questions, user_answers):
     storyline: あやは陶芸の技術を学ぶため訪れた村で、祭りを通じて地元の人々と交流し、芸術の中に隠された物語を知る。
     """
     
-    response = openai.chat.completions.create(
+    content = chat_completion(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "あなたは創造的な絵本のアイデアを生成するプロフェッショナルです。"},
@@ -287,8 +261,7 @@ def story_elements(selected_theme, nouns, questions, user_answers):
         ]
     )
 
-    # ChatCompletion の戻り値を正しく参照
-    elements_text = response.choices[0].message.content.strip()
+    elements_text = content.strip()
     elements = elements_text.split("\n")
     
     # 辞書形式に変換
@@ -301,22 +274,14 @@ def story_elements(selected_theme, nouns, questions, user_answers):
     return story_dict
 
 # Step6 生成された絵本情報をスプレッドシートに追記する関数
-def append_story_elements_to_sheet(story_elements, worksheet):
+def append_story_elements_to_sheet(story_elements):
     # story_elements: Step5で生成された絵本情報（辞書型）
 
     # スプレッドシートに追記するための行データを生成
-    new_row = [
-        story_elements.get("maincharacter", "未設定"),
-        story_elements.get("maincharacter_name", "未設定"),
-        story_elements.get("location", "未設定"),
-        story_elements.get("theme", "未設定"),
-        story_elements.get("subcharacter_A", "未設定"),
-        story_elements.get("subcharacter_B", "未設定"),
-        story_elements.get("storyline", "未設定")
-    ]
+    new_row = [story_elements.get(field, "未設定") for field in STORY_ELEMENT_FIELDS]
 
-    # データをスプレッドシートに追記
-    worksheet.append_row(new_row, value_input_option="USER_ENTERED") 
+    # データを保存先（既定ではスプレッドシートのsheet1）に追記
+    storage.append_story_elements(new_row)
 
 
 # 背景画像設定
@@ -329,6 +294,16 @@ def image_to_base64(image_path):
 background_base64 = image_to_base64(background_image_path)
 logo_base64 = image_to_base64(logo_image_path)
 
+# BLIP・spaCyモデルをバックグラウンドでロード・ウォームアップ（プロセスごとに1回）
+captioning.start_warm_up()
+text_analysis.start_warm_up()
+# Google APIの認証・スプレッドシートのオープンもバックグラウンドで済ませておく（プロセスごとに1回）
+google_clients.start_warm_up(SERVICE_ACCOUNT_INFO, SPREADSHEET_ID)
+
+# モデルの準備が完了しているか
+def models_ready():
+    return captioning.is_ready() and text_analysis.is_ready()
+
 # ページ状態の初期化
 if "page" not in st.session_state:
     st.session_state.page = "main"
@@ -471,21 +446,9 @@ if st.session_state.page == "main":
     
     if st.button("絵本を表示"):
         if input_book_id:
-            # スプレッドシートから絵本データを取得
-            SCOPES = [
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive"
-            ]
-            credentials = Credentials.from_service_account_info(SERVICE_ACCOUNT_INFO, scopes=SCOPES)
-            client = gspread.authorize(credentials)
-            spreadsheet = client.open_by_key(SPREADSHEET_ID)
-            
             try:
-                worksheet = spreadsheet.worksheet("GeneratedBooks")
-                rows = worksheet.get_all_values()  # 全データを取得
-                
-                # 入力された絵本IDに対応するデータを検索
-                book_data = [row for row in rows if row[0] == input_book_id]
+                # 保存先（既定ではスプレッドシートのGeneratedBooksタブ）から絵本データを取得
+                book_data = storage.get_book_pages(input_book_id)
                 
                 if book_data:
                     # 該当データが見つかった場合、セッションに保存してResultページへ
@@ -537,6 +500,10 @@ elif st.session_state.page == "B":
     st.write("Step3　簡単な質問に答えるだけ")
     st.subheader("") # 余白用
 
+    # モデルの準備状況
+    if not models_ready():
+        st.info("画像解析の準備中です。しばらくすると完了します。")
+
     # さっそく作ってみるボタン
     if st.button("さっそく作ってみる", key="B_Step1"):
         set_page("B_Step1")
@@ -556,6 +523,13 @@ elif st.session_state.page == "B_Step1":
 
     # 画像アップロード後
     if uploaded_image:
+        # 新しい画像がアップロードされたら、次のステップを待たずに画像解析を開始
+        if st.session_state.get("analysis_image") != uploaded_image["sha256"]:
+            st.session_state.analysis = start_image_analysis(uploaded_image)
+            st.session_state.analysis_image = uploaded_image["sha256"]
+            for key in ["is_image_analyzed", "themes", "selected_theme"]:
+                st.session_state.pop(key, None)
+
         # セッションにアップロードした画像を保存
         st.session_state.uploaded_image = uploaded_image
 
@@ -583,21 +557,23 @@ elif st.session_state.page == "B_Step2":
         # セッションから画像を取得
         uploaded_image = st.session_state.uploaded_image
 
-        # BLIPによるキャプション生成
-        with st.spinner("BLIPでキャプションを生成中..."):
-            caption = generate_caption_blip(uploaded_image)
-            st.session_state.caption = caption  # キャプションをセッションに保存
+        # アップロード時に開始した画像解析の結果を待つ（未開始・失敗した場合はここで開始し直す）
+        analysis = st.session_state.get("analysis")
+        if analysis is None or analysis.failed():
+            analysis = start_image_analysis(uploaded_image)
+            st.session_state.analysis = analysis
+            st.session_state.analysis_image = uploaded_image["sha256"]
+
+        with st.spinner("画像を解析してテーマを生成中..."):
+            results = analysis.result()
+        print(f"image analysis:\n{analysis.report()}")
+
+        # 解析結果をセッションに保存
+        st.session_state.caption = results["caption"]
+        st.session_state.labels = results["labels"]
+        st.session_state["nouns"] = results["nouns"]
+        st.session_state["themes"] = results["themes"]
 
-        # Vision AIによるラベル抽出
-        with st.spinner("Vision AIでラベルを抽出中..."):
-            labels = extract_labels_visionai(uploaded_image)
-            st.session_state.labels = labels  # ラベルをセッションに保存
-        
-        # 名詞抽出処理を呼び出し
-        with st.spinner("キャプションから名詞を抽出中..."):
-            nouns = extract_nouns(caption, labels, target_language="ja")  # 外部関数を使用
-            st.session_state["nouns"] = nouns  # セッションに保存
-        
         # 解析済みフラグをTrueに設定
         st.session_state.is_image_analyzed = True
         st.success("画像解析が完了しました！")
@@ -618,7 +594,7 @@ elif st.session_state.page == "B_Step2":
     col1, col2 = st.columns([1,2])
 
     with col1:
-        st.image(uploaded_image, caption="アップロードされた画像", use_container_width=True)
+        st.image(uploaded_image["display"], caption="アップロードされた画像", use_container_width=True)
 
     with col2:
         # st.subheader("絵本のテーマを選択してね")
@@ -669,7 +645,7 @@ elif st.session_state.page == "B_Step3":
     col1, col2 = st.columns([1,2])
 
     with col1:
-        st.image(uploaded_image, caption="アップロードされた画像", use_container_width=True)
+        st.image(uploaded_image["display"], caption="アップロードされた画像", use_container_width=True)
 
     with col2:
         
@@ -730,20 +706,10 @@ elif st.session_state.page == "B_Step3":
                     story_elements = story_elements(selected_theme, nouns, questions, user_answers)
                     st.session_state["story_elements"] = story_elements
 
-                    # Google Sheets API 設定
-                    SCOPES = [
-                        "https://www.googleapis.com/auth/spreadsheets",
-                        "https://www.googleapis.com/auth/drive"
-                    ]
-                    credentials = Credentials.from_service_account_info(SERVICE_ACCOUNT_INFO, scopes=SCOPES)
-                    client = gspread.authorize(credentials)
-                    spreadsheet = client.open_by_key(SPREADSHEET_ID)
-                    worksheet = spreadsheet.sheet1
-
                     # Step6 絵本情報をスプレッドシートに追記
                     # 絵本情報をスプレッドシートに追記
                     try:
-                        append_story_elements_to_sheet(story_elements, worksheet)
+                        append_story_elements_to_sheet(story_elements)
                         st.success("スプレッドシートに追記しました")
                     except Exception as e:
                         st.error(f"スプレッドシートへの追記に失敗しました: {e}")
@@ -790,6 +756,7 @@ elif st.session_state.page == "result":
         keys_to_clear = [
             "loaded_book_data", "selected_prompt", "story_elements",
             "uploaded_image", "is_image_analyzed", "nouns",
+            "analysis", "analysis_image",
             "themes", "deep_questions", "user_answers"
         ]
         for key in keys_to_clear:
@@ -812,7 +779,8 @@ elif st.session_state.page == "result":
             st.markdown(f"### ページ {page_number}")
             st.write(story)
             if image_url:
-                st.image(image_url, caption=f"ページ {page_number} のイラスト")
+                # ローカルに保存した画像があればそちらを表示
+                st.image(get_image_source(image_url), caption=f"ページ {page_number} のイラスト")
             else:
                 st.warning(f"ページ {page_number} の画像が見つかりません。")
 
@@ -842,62 +810,63 @@ elif st.session_state.page == "result":
 
         sub_characters = [char for char in [subcharacter_A, subcharacter_B] if char]
 
-        # 絵本を生成
+        # 絵本を生成（完成したページから順に表示）
+        num_pages = 5
+        result_message = st.empty()
+        st.markdown('<h2 style="text-align: center;">📖 あなたの絵本 📖</h2>', unsafe_allow_html=True)
+
+        # ページごとの表示枠を先に用意しておく
+        page_placeholders = [st.empty() for _ in range(num_pages)]
+        for i, placeholder in enumerate(page_placeholders, 1):
+            placeholder.info(f"ページ {i} を生成中...")
+
+        full_story = [""] * num_pages
+        image_urls = [None] * num_pages
+
         with st.spinner("絵本を生成しています。少々お待ちください..."):
             try:
-                full_story, image_urls = generate_full_story_and_images(
+                for page_number, story, image_url in iter_story_and_images(
                     main_character=maincharacter,
                     main_character_name=maincharacter_name,
                     theme=theme,
                     sub_characters=sub_characters,
                     storyline=storyline,
                     target_age=5,
-                    num_pages=5,
-                )
-
-                # Google Spreadsheetへの保存準備
-                credentials = Credentials.from_service_account_info(SERVICE_ACCOUNT_INFO, scopes=[
-                    "https://www.googleapis.com/auth/spreadsheets",
-                    "https://www.googleapis.com/auth/drive"
-                ])
-                client = gspread.authorize(credentials)
-                spreadsheet = client.open_by_key(SPREADSHEET_ID)
-
-                # "GeneratedBooks"タブを取得または作成
-                try:
-                    worksheet = spreadsheet.worksheet("GeneratedBooks")
-                except gspread.exceptions.WorksheetNotFound:
-                    worksheet = spreadsheet.add_worksheet(title="GeneratedBooks", rows=1000, cols=10)
-                    worksheet.append_row(["絵本ID", "ページ番号", "ページの話", "IdeogramのURL"])
+                    num_pages=num_pages,
+                ):
+                    full_story[page_number - 1] = story
+                    image_urls[page_number - 1] = image_url
+
+                    with page_placeholders[page_number - 1].container():
+                        st.markdown(f"### ページ {page_number}")
+                        st.write(story)
+                        if image_url:
+                            st.image(get_image_source(image_url), caption=f"ページ {page_number} のイラスト")
+                        else:
+                            st.warning(f"ページ {page_number} の画像生成に失敗しました。")
 
                 # 絵本IDを自動生成
-                book_id = generate_next_book_id(worksheet)
+                book_id = storage.next_book_id()
 
-                # データをスプレッドシートに保存
-                for page_number, (story, image_url) in enumerate(zip(full_story, image_urls), 1):
-                    worksheet.append_row([
+                # データを保存先（既定ではスプレッドシートのGeneratedBooksタブ）に保存
+                storage.append_book_pages([
+                    [
                         book_id,                # 絵本ID
                         page_number,            # ページ番号
                         story,                  # ページの話
                         image_url               # IdeogramのURL
-                    ])
+                    ]
+                    for page_number, (story, image_url) in enumerate(zip(full_story, image_urls), 1)
+                ])
 
             except Exception as e:
                 st.error(f"絵本の生成中にエラーが発生しました: {e}")
                 st.stop()
 
         # 結果を表示
-        st.success(f"絵本が完成しました！ あなたの絵本IDは **{book_id}** です！")
-        st.markdown("この絵本IDを保存しておけば、後で絵本を再表示することができます！")
-        st.markdown('<h2 style="text-align: center;">📖 あなたの絵本 📖</h2>', unsafe_allow_html=True)
-
-        for i, (story, image_url) in enumerate(zip(full_story, image_urls), 1):
-            st.markdown(f"### ページ {i}")
-            st.write(story)
-            if image_url:
-                st.image(image_url, caption=f"ページ {i} のイラスト")
-            else:
-                st.warning(f"ページ {i} の画像生成に失敗しました。")
+        with result_message.container():
+            st.success(f"絵本が完成しました！ あなたの絵本IDは **{book_id}** です！")
+            st.markdown("この絵本IDを保存しておけば、後で絵本を再表示することができます！")
 
     else:
         st.error("絵本データが見つかりません。メインページに戻り、絵本IDを入力するか、新しい絵本を作成してください。")
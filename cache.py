@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+# キャッシュの保存先（SQLiteファイルを置くディレクトリ）
+CACHE_DIR = Path(os.getenv("EHON_CACHE_DIR", ".cache"))
+
+# キャッシュキーを作成（JSONに変換できる値からSHA-256を計算）
+def make_cache_key(*parts):
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# 最終アクセス時刻の更新をまとめて書き込む間隔（読み出しのたびにコミットしないため）
+TOUCH_FLUSH_INTERVAL = 30.0  # 秒
+TOUCH_FLUSH_ENTRIES = 256
+
+# SQLiteを使った永続キャッシュ
+# - ttl: 有効期限（秒）。None の場合は期限なし
+# - max_entries / max_bytes: 上限を超えたら最終アクセスが古いものから削除（LRU）。None の場合は上限なし
+# イベントループ上からは get_async / set_async を使う（SQLiteの読み書きをスレッドで行う）
+class SqliteCache:
+    def __init__(self, name, ttl=None, max_entries=10000, max_bytes=100 * 1024 * 1024, cache_dir=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        cache_dir = Path(cache_dir or CACHE_DIR)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = cache_dir / f"{name}.sqlite3"
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # キャッシュは失われても作り直せるので、コミットごとのfsyncは行わない
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # まだ書き込んでいない最終アクセス時刻（キー → 時刻）
+        self._touched = {}
+        self._touched_flushed_at = time.monotonic()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return default
+
+            value, created_at = row
+            if self.ttl is not None and now - created_at > self.ttl:
+                # 期限切れ（削除は次の書き込み時の _evict で行う）
+                self.misses += 1
+                return default
+
+            self._touched[key] = now
+            if (
+                len(self._touched) >= TOUCH_FLUSH_ENTRIES
+                or time.monotonic() - self._touched_flushed_at >= TOUCH_FLUSH_INTERVAL
+            ):
+                self._flush_touched()
+                self._conn.commit()
+            self.hits += 1
+            return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data.encode("utf-8")), now, now)
+            )
+            self._touched.pop(key, None)
+            self._flush_touched()
+            self._evict()
+            self._conn.commit()
+
+    async def get_async(self, key, default=None):
+        return await asyncio.to_thread(self.get, key, default)
+
+    async def set_async(self, key, value):
+        await asyncio.to_thread(self.set, key, value)
+
+    # 溜めておいた最終アクセス時刻を書き込む（コミットは呼び出し側で行う）
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()]
+            )
+            self._touched.clear()
+        self._touched_flushed_at = time.monotonic()
+
+    def delete(self, key):
+        with self._lock:
+            self._touched.pop(key, None)
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    # 保存されているキーの一覧（最終アクセスが新しい順）
+    def keys(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            if self.ttl is not None:
+                rows = self._conn.execute(
+                    "SELECT key FROM cache WHERE created_at >= ? ORDER BY accessed_at DESC",
+                    (time.time() - self.ttl,)
+                ).fetchall()
+            else:
+                rows = self._conn.execute("SELECT key FROM cache ORDER BY accessed_at DESC").fetchall()
+        return [row[0] for row in rows]
+
+    # 件数・容量の上限を超えた分を最終アクセスが古い順に削除
+    def _evict(self):
+        if self.ttl is not None:
+            cursor = self._conn.execute("DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl,))
+            self.evictions += cursor.rowcount
+
+        count, total_size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        while (
+            (self.max_entries is not None and count > self.max_entries)
+            or (self.max_bytes is not None and total_size > self.max_bytes)
+        ):
+            key, size = self._conn.execute("SELECT key, size FROM cache ORDER BY accessed_at LIMIT 1").fetchone()
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.evictions += 1
+            count -= 1
+            total_size -= size
+
+    def stats(self):
+        with self._lock:
+            count, total_size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": count,
+            "bytes": total_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# プロセス内のLRUキャッシュ（ディスクに保存しない、小さく頻繁に使うデータ用）
+class LruCache:
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,152 @@
+import io
+import os
+import sys
+import time
+import queue
+import threading
+from collections import deque
+from multiprocessing.connection import Listener
+from PIL import Image
+from captioning import (
+    CAPTION_SERVER, CAPTION_SERVER_AUTHKEY, LOOPBACK_HOSTS, generate_captions, parse_address, require_authkey, warm_up
+)
+
+# キャプションサーバー
+# Streamlitとは別プロセスでBLIPを動かし、短い時間窓の間に届いたリクエストを
+# 1回の model.generate にまとめて処理する
+#
+# 起動方法（アプリ側と同じ EHON_CAPTION_SERVER_AUTHKEY を設定しておく）:
+#   python caption_server.py 127.0.0.1:6010
+#   python caption_server.py unix:/run/ehon/caption.sock
+# アプリ側は EHON_CAPTION_SERVER=127.0.0.1:6010 を設定して起動する
+# 受信したメッセージはpickleとして復元するため、待ち受けはループバックかUnixソケットに限る
+
+DEFAULT_ADDRESS = "127.0.0.1:6010"
+BATCH_WINDOW = 0.02  # 最初のリクエストから追加のリクエストを待つ時間（秒）
+MAX_BATCH_SIZE = 8
+
+
+class CaptionServer:
+    def __init__(self, address, authkey=CAPTION_SERVER_AUTHKEY, batch_window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE):
+        self.address = parse_address(address)
+        if isinstance(self.address, tuple) and self.address[0] not in LOOPBACK_HOSTS:
+            raise ValueError(f"キャプションサーバーはループバックアドレスかUnixソケットでのみ待ち受けできます: {address}")
+        self.authkey = require_authkey(authkey)
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._requests = queue.Queue()
+
+        # メトリクス
+        self._stats_lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.batches = 0
+        self.captions = 0
+        self.errors = 0
+        self._batch_sizes = deque(maxlen=1000)
+        self._queue_latencies = deque(maxlen=1000)
+        self._inference_times = deque(maxlen=1000)
+        self._completed_at = deque(maxlen=1000)
+
+    def serve_forever(self):
+        warm_up()
+        threading.Thread(target=self._batch_loop, name="caption-batcher", daemon=True).start()
+
+        with Listener(self.address, backlog=64, authkey=self.authkey) as listener:
+            if isinstance(self.address, str):
+                # Unixソケットは同じユーザーのプロセスからだけ接続できるようにする
+                os.chmod(self.address, 0o600)
+            print(f"Caption server listening on {listener.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"Warning: Failed to accept connection: {e}")
+                    continue
+                threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    # 1接続ごとのリクエスト受付（結果はバッチ処理側から返す）
+    def _handle_connection(self, conn):
+        reply = threading.Event()
+        try:
+            while True:
+                kind, payload = conn.recv()
+                if kind == "caption":
+                    reply.clear()
+                    self._requests.put((conn, reply, payload, time.monotonic()))
+                    # クライアントは1接続で1リクエストずつ送るため、返信が終わるまで待つ
+                    reply.wait()
+                elif kind == "stats":
+                    conn.send(("ok", self.stats()))
+                else:
+                    conn.send(("error", f"unknown request: {kind}"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    # 時間窓の間に届いたリクエストをまとめて推論する
+    def _batch_loop(self):
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            started_at = time.monotonic()
+            try:
+                images = [Image.open(io.BytesIO(payload)) for _, _, payload, _ in batch]
+                results = [("ok", caption) for caption in generate_captions(images)]
+            except Exception as e:
+                print(f"Error: Caption batch failed: {e}")
+                results = [("error", str(e))] * len(batch)
+            finished_at = time.monotonic()
+
+            for (conn, reply, _, _), result in zip(batch, results):
+                try:
+                    conn.send(result)
+                except (EOFError, OSError):
+                    pass
+                reply.set()
+
+            self._record(batch, results, started_at, finished_at)
+
+    def _record(self, batch, results, started_at, finished_at):
+        with self._stats_lock:
+            self.batches += 1
+            self.captions += sum(1 for status, _ in results if status == "ok")
+            self.errors += sum(1 for status, _ in results if status != "ok")
+            self._batch_sizes.append(len(batch))
+            self._inference_times.append(finished_at - started_at)
+            for _, _, _, enqueued_at in batch:
+                self._queue_latencies.append(started_at - enqueued_at)
+                self._completed_at.append(finished_at)
+
+        print(f"Caption batch: size={len(batch)}, queue={1000 * max(started_at - item[3] for item in batch):.0f}ms, "
+              f"inference={1000 * (finished_at - started_at):.0f}ms")
+
+    def stats(self):
+        with self._stats_lock:
+            now = time.monotonic()
+            recent = [t for t in self._completed_at if now - t <= 60]
+            return {
+                "batches": self.batches,
+                "captions": self.captions,
+                "errors": self.errors,
+                "queue_depth": self._requests.qsize(),
+                "avg_batch_size": sum(self._batch_sizes) / len(self._batch_sizes) if self._batch_sizes else 0.0,
+                "avg_queue_latency": sum(self._queue_latencies) / len(self._queue_latencies) if self._queue_latencies else 0.0,
+                "avg_inference_time": sum(self._inference_times) / len(self._inference_times) if self._inference_times else 0.0,
+                "throughput_per_sec": self.captions / (now - self.started_at),
+                "recent_throughput_per_sec": len(recent) / 60,
+            }
+
+
+if __name__ == "__main__":
+    address = sys.argv[1] if len(sys.argv) > 1 else (CAPTION_SERVER or DEFAULT_ADDRESS)
+    CaptionServer(address).serve_forever()
@@ -0,0 +1,228 @@
+import io
+import os
+import queue
+import threading
+import torch
+from pathlib import Path
+from multiprocessing.connection import Client
+from PIL import Image
+from transformers import BlipProcessor, BlipForConditionalGeneration
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+from cache import CACHE_DIR
+from model_assets import ensure_blip
+
+# BLIPによるキャプション生成
+# モデルはプロセス全体で1回だけロードし、全セッションで使い回す
+# EHON_CAPTION_SERVER（例: "127.0.0.1:6010"）を設定すると、
+# 別プロセスのキャプションサーバー（caption_server.py）に推論を任せる
+
+# 推論バックエンド
+# "fp32": 通常のPyTorch / "int8": Linear層を動的int8量子化 / "onnx": 画像エンコーダーをONNX Runtimeで実行
+# （"onnx" を使う場合は onnxruntime をインストールしておく）
+CAPTION_BACKEND = os.getenv("EHON_CAPTION_BACKEND", "fp32")
+CAPTION_BACKENDS = ("fp32", "int8", "onnx")
+# 推論に使うCPUスレッド数（0の場合はPyTorch / ONNX Runtimeの既定値）
+CAPTION_NUM_THREADS = int(os.getenv("EHON_CAPTION_THREADS", "0"))
+# ONNXモデルの保存先
+ONNX_MODEL_DIR = Path(os.getenv("EHON_ONNX_MODEL_DIR", str(CACHE_DIR / "onnx")))
+
+# 起動時にダミー画像で1回推論しておく（初回ユーザーのコールドスタートを避ける）
+BLIP_WARM_UP = os.getenv("EHON_BLIP_WARM_UP", "1") == "1"
+
+# キャプションサーバーの接続先と認証キー
+# 接続先は "127.0.0.1:6010" のようなループバックのアドレス、または "unix:/path/to/socket"
+# 受信したメッセージはpickleとして復元されるため、認証キーは既定値を持たず、必ず環境変数で設定する
+CAPTION_SERVER = os.getenv("EHON_CAPTION_SERVER", "")
+CAPTION_SERVER_AUTHKEY = os.getenv("EHON_CAPTION_SERVER_AUTHKEY", "").encode()
+# サーバーからの応答を待つ最大時間（秒）
+CAPTION_SERVER_TIMEOUT = float(os.getenv("EHON_CAPTION_SERVER_TIMEOUT", "30"))
+
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+# サーバーへ送る画像の最大サイズ（BLIPは384x384に縮小して使うため、それ以上は送らない）
+CAPTION_TRANSPORT_MAX_SIZE = 768
+
+_blip_models = {}
+_blip_lock = threading.Lock()
+_warm_up_thread = None
+_warm_up_lock = threading.Lock()
+_warmed_up = False
+_caption_client = None
+
+# BLIPのプロセッサとモデルを取得（バックエンドごとに初回のみロード）
+def get_blip(backend=None):
+    backend = backend or CAPTION_BACKEND
+    if backend not in CAPTION_BACKENDS:
+        raise ValueError(f"未対応のキャプションバックエンドです: {backend}")
+
+    with _blip_lock:
+        if backend not in _blip_models:
+            if CAPTION_NUM_THREADS > 0:
+                torch.set_num_threads(CAPTION_NUM_THREADS)
+
+            # 事前に取得したローカルのモデルファイルだけを読み込む
+            model_dir = ensure_blip()
+            processor = BlipProcessor.from_pretrained(model_dir, local_files_only=True)
+            model = BlipForConditionalGeneration.from_pretrained(model_dir, local_files_only=True)
+            model.eval()
+
+            if backend == "int8":
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            elif backend == "onnx":
+                model.vision_model = OnnxVisionModel(export_vision_model_onnx(model))
+
+            _blip_models[backend] = (processor, model)
+        return _blip_models[backend]
+
+# 複数の画像のキャプションを1回の推論でまとめて生成
+def generate_captions(images, backend=None):
+    processor, model = get_blip(backend)
+
+    inputs = processor(images=[image.convert("RGB") for image in images], return_tensors="pt")
+    with torch.inference_mode():
+        outputs = model.generate(**inputs)
+    return processor.batch_decode(outputs, skip_special_tokens=True)
+
+
+# ONNXエクスポート用に画像エンコーダーの出力を last_hidden_state だけにするラッパー
+class _VisionModelForExport(torch.nn.Module):
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+# BLIPの画像エンコーダーをONNXに書き出す（書き出し済みなら再利用）
+def export_vision_model_onnx(model):
+    onnx_path = ONNX_MODEL_DIR / "blip_vision_model.onnx"
+    if not onnx_path.exists():
+        ONNX_MODEL_DIR.mkdir(parents=True, exist_ok=True)
+        image_size = model.config.vision_config.image_size
+        tmp_path = onnx_path.with_suffix(".onnx.tmp")
+        torch.onnx.export(
+            _VisionModelForExport(model.vision_model),
+            torch.zeros(1, 3, image_size, image_size),
+            str(tmp_path),
+            input_names=["pixel_values"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+            opset_version=17
+        )
+        os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+# 画像エンコーダーをONNX Runtimeで実行するモジュール（テキストデコーダーはPyTorchのまま）
+class OnnxVisionModel(torch.nn.Module):
+    def __init__(self, onnx_path):
+        super().__init__()
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if CAPTION_NUM_THREADS > 0:
+            options.intra_op_num_threads = CAPTION_NUM_THREADS
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+
+    def forward(self, pixel_values, **kwargs):
+        (last_hidden_state,) = self.session.run(None, {"pixel_values": pixel_values.numpy()})
+        return BaseModelOutputWithPooling(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+def generate_caption(image):
+    if CAPTION_SERVER:
+        return get_caption_client().caption(image)
+    return generate_captions([image])[0]
+
+def warm_up():
+    global _warmed_up
+    generate_captions([Image.new("RGB", (384, 384), "white")])
+    _warmed_up = True
+
+def load_only():
+    global _warmed_up
+    get_blip()
+    _warmed_up = True
+
+# モデルのロード（とウォームアップ）が完了しているか
+def is_ready():
+    return bool(CAPTION_SERVER) or _warmed_up
+
+# バックグラウンドでモデルのロードとウォームアップを開始（何度呼んでも1回だけ実行）
+def start_warm_up():
+    global _warm_up_thread
+    if CAPTION_SERVER:
+        # 推論はサーバー側で行うため、このプロセスではモデルをロードしない
+        return None
+
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            target = warm_up if BLIP_WARM_UP else load_only
+            _warm_up_thread = threading.Thread(target=target, name="blip-warm-up", daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
+
+# 画像をサーバーへ送るためのバイト列に変換
+def encode_for_transport(image):
+    image = image.convert("RGB")
+    image.thumbnail((CAPTION_TRANSPORT_MAX_SIZE, CAPTION_TRANSPORT_MAX_SIZE))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+# 接続先の文字列を multiprocessing.connection のアドレスに変換
+# "unix:/path" はUnixソケットのパス、それ以外は (ホスト, ポート)
+def parse_address(address):
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+def require_authkey(authkey):
+    if not authkey:
+        raise RuntimeError("環境変数 EHON_CAPTION_SERVER_AUTHKEY が設定されていません。")
+    return authkey
+
+
+# キャプションサーバーのクライアント
+# 接続はスレッドをまたいで共有できないため、空いている接続をプールして使い回す
+class CaptionClient:
+    def __init__(self, address, authkey=CAPTION_SERVER_AUTHKEY, timeout=CAPTION_SERVER_TIMEOUT):
+        self.address = parse_address(address)
+        self.authkey = require_authkey(authkey)
+        self.timeout = timeout
+        self._idle = queue.SimpleQueue()
+
+    def _request(self, message):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = Client(self.address, authkey=self.authkey)
+
+        try:
+            conn.send(message)
+            # 応答がないまま止まったサーバーでセッションが固まらないよう、待ち時間を制限する
+            if not conn.poll(self.timeout):
+                raise TimeoutError(f"キャプションサーバーから {self.timeout:.0f} 秒以内に応答がありませんでした")
+            status, result = conn.recv()
+        except (EOFError, OSError):
+            # TimeoutError も OSError の一種（遅れて届く応答と混ざらないよう接続ごと捨てる）
+            conn.close()
+            raise
+
+        self._idle.put(conn)
+        if status != "ok":
+            raise RuntimeError(f"キャプションサーバーでエラーが発生しました: {result}")
+        return result
+
+    def caption(self, image):
+        return self._request(("caption", encode_for_transport(image)))
+
+    # バッチサイズ・待ち時間・スループットなどの統計
+    def stats(self):
+        return self._request(("stats", None))
+
+def get_caption_client():
+    global _caption_client
+    with _warm_up_lock:
+        if _caption_client is None:
+            _caption_client = CaptionClient(CAPTION_SERVER)
+        return _caption_client
@@ -0,0 +1 @@
+# テストからリポジトリ直下のモジュールを import できるようにする（pytest がこのディレクトリを sys.path に追加する）
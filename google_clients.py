@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+import datetime
+import requests
+import gspread
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+from google.cloud import vision
+
+# Google APIクライアントの共通管理
+# サービスアカウントごとに、認証・スプレッドシートのオープン・クライアントの作成をプロセス内で1回だけ行い、
+# 全セッションで使い回す
+# スプレッドシートはgspread（requests.Session）だけで読み書きし、ディスカバリー文書の取得は行わない
+# アクセストークンは期限が切れる前にバックグラウンドで更新するため、リクエストの処理中にOAuthの通信は発生しない
+
+SHEETS_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+CLOUD_PLATFORM_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+TOKEN_REFRESH_MARGIN = int(os.getenv("EHON_TOKEN_REFRESH_MARGIN", "300"))  # 期限の何秒前に更新するか
+TOKEN_CHECK_INTERVAL = 60  # 秒
+
+class GoogleClients:
+    def __init__(self, service_account_info):
+        self.service_account_info = service_account_info
+        self._lock = threading.RLock()
+        self._credentials = {}
+        self._gspread_client = None
+        self._spreadsheets = {}
+        self._worksheets = {}
+        self._vision_client = None
+        # トークン取得の通信で使い回すHTTPセッション
+        self._token_session = requests.Session()
+
+    # スコープごとの認証情報（有効なアクセストークン付き）
+    def credentials(self, scopes=SHEETS_SCOPES):
+        key = tuple(scopes)
+        with self._lock:
+            credentials = self._credentials.get(key)
+            if credentials is None:
+                credentials = Credentials.from_service_account_info(self.service_account_info, scopes=list(scopes))
+                self._credentials[key] = credentials
+            self._refresh_if_needed(credentials)
+            return credentials
+
+    def _refresh_if_needed(self, credentials):
+        expiry = credentials.expiry
+        margin = datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN)
+        # google-auth の expiry はタイムゾーンなしのUTC
+        if not credentials.token or expiry is None or expiry - margin <= datetime.datetime.utcnow():
+            credentials.refresh(Request(self._token_session))
+
+    # 期限が近いトークンをまとめて更新（バックグラウンドのスレッドから呼ぶ）
+    def refresh_tokens(self):
+        with self._lock:
+            for credentials in self._credentials.values():
+                try:
+                    self._refresh_if_needed(credentials)
+                except Exception as e:
+                    print(f"Warning: Failed to refresh Google access token: {e}")
+
+    # gspreadのクライアント（HTTPセッションを使い回す）
+    def gspread_client(self):
+        with self._lock:
+            if self._gspread_client is None:
+                # 内部で AuthorizedSession（requests.Session）を1つ持ち、接続を使い回す
+                self._gspread_client = gspread.authorize(self.credentials(SHEETS_SCOPES))
+            return self._gspread_client
+
+    def spreadsheet(self, spreadsheet_id):
+        with self._lock:
+            if spreadsheet_id not in self._spreadsheets:
+                self._spreadsheets[spreadsheet_id] = self.gspread_client().open_by_key(spreadsheet_id)
+            return self._spreadsheets[spreadsheet_id]
+
+    # ファイル名で開くスプレッドシート（result.py用）
+    def spreadsheet_by_name(self, name):
+        with self._lock:
+            key = ("name", name)
+            if key not in self._spreadsheets:
+                self._spreadsheets[key] = self.gspread_client().open(name)
+            return self._spreadsheets[key]
+
+    # ワークシート（見つからなければ gspread.exceptions.WorksheetNotFound）
+    def worksheet(self, spreadsheet, title):
+        key = (spreadsheet.id, title)
+        with self._lock:
+            if key not in self._worksheets:
+                self._worksheets[key] = spreadsheet.worksheet(title)
+            return self._worksheets[key]
+
+    # Vision AIのクライアント（gRPCチャネルを使い回す）
+    def vision_client(self):
+        with self._lock:
+            if self._vision_client is None:
+                self._vision_client = vision.ImageAnnotatorClient(credentials=self.credentials(CLOUD_PLATFORM_SCOPES))
+            return self._vision_client
+
+    # 起動時にまとめて認証・オープンしておく
+    def warm_up(self, spreadsheet_id=None):
+        self.credentials(SHEETS_SCOPES)
+        self.credentials(CLOUD_PLATFORM_SCOPES)
+        if spreadsheet_id:
+            self.spreadsheet(spreadsheet_id)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_refresh_thread = None
+_warm_up_thread = None
+
+def _refresh_loop():
+    while True:
+        time.sleep(TOKEN_CHECK_INTERVAL)
+        with _registry_lock:
+            clients = list(_registry.values())
+        for client in clients:
+            client.refresh_tokens()
+
+# サービスアカウントごとに共有するクライアント
+def get_clients(service_account_info):
+    global _refresh_thread
+    key = service_account_info["client_email"]
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = GoogleClients(service_account_info)
+        if _refresh_thread is None:
+            _refresh_thread = threading.Thread(target=_refresh_loop, name="google-token-refresh", daemon=True)
+            _refresh_thread.start()
+        return _registry[key]
+
+# 起動時にバックグラウンドで認証・スプレッドシートのオープンを済ませる（プロセスごとに1回）
+def start_warm_up(service_account_info, spreadsheet_id=None):
+    global _warm_up_thread
+
+    def run():
+        try:
+            get_clients(service_account_info).warm_up(spreadsheet_id)
+        except Exception as e:
+            print(f"Warning: Failed to warm up Google API clients: {e}")
+
+    with _registry_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=run, name="google-warm-up", daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
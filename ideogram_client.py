@@ -0,0 +1,127 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+import httpx
+from scheduler import PRIORITY_BULK
+
+IDEOGRAM_API_URL = "https://api.ideogram.ai/generate"
+
+# リトライ対象のHTTPステータス（レート制限・サーバーエラー）
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# Ideogram API クライアント
+# - コネクションプール + keep-alive で TLS ハンドシェイクを使い回す
+# - 接続・読み込みタイムアウト
+# - 429 / 5xx / 通信エラーはジッター付き指数バックオフでリトライ
+# - リクエストごとのレイテンシを記録
+class IdeogramClient:
+    def __init__(self, api_key, api_url=IDEOGRAM_API_URL, connect_timeout=10, read_timeout=120,
+                 max_retries=4, backoff_base=1.0, backoff_max=30.0, max_connections=20, scheduler=None):
+        self.api_key = api_key
+        self.scheduler = scheduler
+        self.api_url = api_url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._http = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60
+            )
+        )
+
+        # メトリクス
+        self._metrics_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    # 画像生成リクエスト（scheduler があればリトライも含めて送信枠を確保してから送る）
+    async def generate(self, image_request, priority=PRIORITY_BULK):
+        headers = {
+            "Api-Key": self.api_key,
+            "Content-Type": "application/json",
+            "accept": "application/json"
+        }
+        rate_limit = (image_request.get("model", "*"), priority)
+        return await self.request("POST", self.api_url, headers=headers, json={"image_request": image_request}, rate_limit=rate_limit)
+
+    # 生成画像のダウンロードなど、APIキーを付けないGETリクエスト
+    async def get(self, url):
+        return await self.request("GET", url)
+
+    async def request(self, method, url, rate_limit=None, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if self.scheduler and rate_limit:
+                model, priority = rate_limit
+                await self.scheduler.acquire_async("ideogram", model, priority=priority)
+
+            start = time.perf_counter()
+            try:
+                response = await self._http.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self._record(time.perf_counter() - start)
+                if attempt == self.max_retries:
+                    self._record_failure()
+                    raise
+                print(f"Warning: Ideogram request failed ({e!r}), retrying...")
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            self._record(time.perf_counter() - start)
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            if attempt == self.max_retries:
+                self._record_failure()
+                return response
+
+            print(f"Warning: Ideogram returned HTTP {response.status_code}, retrying...")
+            await asyncio.sleep(self._backoff(attempt, response.headers.get("retry-after")))
+
+    # ジッター付き指数バックオフの待ち時間（Retry-After があればそれ以上待つ）
+    def _backoff(self, attempt, retry_after=None):
+        with self._metrics_lock:
+            self.retries += 1
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+    def _record(self, latency):
+        with self._metrics_lock:
+            self.requests += 1
+            self._latencies.append(latency)
+
+    def _record_failure(self):
+        with self._metrics_lock:
+            self.failures += 1
+
+    # レイテンシ（秒）などの集計
+    def metrics(self):
+        with self._metrics_lock:
+            latencies = sorted(self._latencies)
+            metrics = {
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+            }
+        if latencies:
+            metrics.update({
+                "latency_avg": sum(latencies) / len(latencies),
+                "latency_p50": latencies[len(latencies) // 2],
+                "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                "latency_max": latencies[-1],
+            })
+        return metrics
+
+    async def aclose(self):
+        await self._http.aclose()
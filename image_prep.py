@@ -0,0 +1,88 @@
+import io
+import hashlib
+from PIL import Image, ImageOps
+from vision_labels import encode_for_vision
+
+# アップロード画像の前処理
+# アップロード時に1回だけ向きの補正・縮小・エンコードを行い、
+# 表示・BLIP・Vision AIの各処理はそれぞれ用意した画像を使う
+# セッションにはデコード済みの画像ではなく、圧縮したバイト列だけを保存する
+
+DISPLAY_MAX_EDGE = 800  # 表示用サムネイルの長辺（px）
+DISPLAY_JPEG_QUALITY = 85
+MODEL_INPUT_SIZE = 384  # BLIPの入力サイズ（px）
+PHASH_SIZE = 8  # 知覚ハッシュの一辺（8x8 = 64ビット）
+THUMBNAIL_SIZE = 8  # 色の比較に使う縮小画像の一辺（8x8 RGB）
+# 知覚ハッシュの1のビットの数がこの範囲外なら、絵の特徴ではなく明るさのむら（照明の傾き）を表しているとみなす
+PHASH_MIN_ONES = 16
+PHASH_MAX_ONES = PHASH_SIZE * PHASH_SIZE - PHASH_MIN_ONES
+
+def image_fingerprint(file_bytes):
+    return hashlib.sha256(file_bytes).hexdigest()
+
+# 知覚ハッシュ（dHash）
+# 縮小したグレースケール画像で隣り合う画素の明暗を比べるため、
+# 撮り直し・再圧縮・多少の明るさの違いがあっても近い値になる
+def perceptual_hash(image):
+    small = image.convert("L").resize((PHASH_SIZE + 1, PHASH_SIZE), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for y in range(PHASH_SIZE):
+        row = pixels[y * (PHASH_SIZE + 1):(y + 1) * (PHASH_SIZE + 1)]
+        for x in range(PHASH_SIZE):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return f"{bits:0{PHASH_SIZE * PHASH_SIZE // 4}x}"
+
+# 2つの知覚ハッシュの異なるビット数
+def hash_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+# 知覚ハッシュで絵を見分けられるか（ほぼ白い紙を撮った写真などは明るさのむらしか表さない）
+def is_distinctive_hash(phash):
+    return PHASH_MIN_ONES <= bin(int(phash, 16)).count("1") <= PHASH_MAX_ONES
+
+# 色の比較用の縮小画像（8x8 RGB の画素値を16進数の文字列にしたもの）
+def color_thumbnail(image):
+    return image.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR).tobytes().hex()
+
+# 2つの縮小画像の色の違い（画素ごとの差の平均、0〜255）
+# 撮り直したときの全体の明るさの違いは、チャンネルごとに平均を引いてから比べることで無視する
+def thumbnail_distance(thumbnail_a, thumbnail_b):
+    a, b = bytes.fromhex(thumbnail_a), bytes.fromhex(thumbnail_b)
+    if len(a) != len(b):
+        return 255.0
+    offsets = []
+    for channel in range(3):
+        offsets.append((sum(a[channel::3]) - sum(b[channel::3])) / (len(a) // 3))
+    return sum(abs(x - y - offsets[i % 3]) for i, (x, y) in enumerate(zip(a, b))) / len(a)
+
+def _encode(image, format, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **params)
+    return buffer.getvalue()
+
+# アップロードされたファイルから各用途の画像を作成
+# 戻り値: {"sha256", "phash", "thumbnail", "width", "height", "display", "model", "transport"}（画像はすべてバイト列）
+def preprocess_upload(file_bytes):
+    original = Image.open(io.BytesIO(file_bytes))
+    image = ImageOps.exif_transpose(original).convert("RGB")
+
+    display = image.copy()
+    display.thumbnail((DISPLAY_MAX_EDGE, DISPLAY_MAX_EDGE))
+
+    model_input = image.resize((MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), Image.BICUBIC)
+
+    return {
+        "sha256": image_fingerprint(file_bytes),
+        "phash": perceptual_hash(image),
+        "thumbnail": color_thumbnail(image),
+        "width": image.width,
+        "height": image.height,
+        "display": _encode(display, "JPEG", quality=DISPLAY_JPEG_QUALITY),
+        "model": _encode(model_input, "PNG"),
+        "transport": encode_for_vision(original, file_bytes, oriented=image),
+    }
+
+# 前処理済みのバイト列を画像として開く
+def open_image(image_bytes):
+    return Image.open(io.BytesIO(image_bytes))
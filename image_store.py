@@ -0,0 +1,93 @@
+import os
+import uuid
+import asyncio
+import hashlib
+from pathlib import Path
+from cache import CACHE_DIR, SqliteCache, make_cache_key
+
+# 生成画像のローカル保存先（ファイル名は内容のSHA-256）
+IMAGE_DIR = Path(os.getenv("EHON_IMAGE_DIR", str(CACHE_DIR / "images")))
+
+# ダウンロードに失敗した画像URLを再試行しない時間（秒）
+MIRROR_RETRY_AFTER = int(os.getenv("EHON_IMAGE_MIRROR_RETRY_AFTER", str(6 * 60 * 60)))
+
+# 画像URL → ローカルファイル名
+# 保存済みの絵本の画像はIdeogramのURLが期限切れになった後もこの対応で表示するため、削除しない（上限なし）
+image_mirror = SqliteCache("image_mirror", max_entries=None, max_bytes=None)
+# ダウンロードに失敗した画像URL（期限切れのURLに何度もアクセスしないため）
+mirror_failures = SqliteCache("image_mirror_failures", ttl=MIRROR_RETRY_AFTER, max_entries=50000)
+# 画像プロンプト + 生成パラメータ → 画像URL
+prompt_cache = SqliteCache("image_prompts", max_entries=20000)
+
+_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+}
+
+def prompt_key(prompt, params):
+    return make_cache_key(prompt, params)
+
+# 同じプロンプト・パラメータで生成済みの画像URLを取得（ローカルに画像が残っているものだけ）
+def get_cached_image(key):
+    image_url = prompt_cache.get(key)
+    if image_url and local_image_path(image_url):
+        return image_url
+    return None
+
+def cache_image(key, image_url):
+    prompt_cache.set(key, image_url)
+
+# イベントループ上から呼ぶ版（SQLite・ファイルの確認はスレッドで行う）
+async def get_cached_image_async(key):
+    return await asyncio.to_thread(get_cached_image, key)
+
+async def cache_image_async(key, image_url):
+    await prompt_cache.set_async(key, image_url)
+
+# ミラー済みの画像のローカルパス（未取得なら None）
+def local_image_path(image_url):
+    if not image_url:
+        return None
+    filename = image_mirror.get(make_cache_key(image_url))
+    if filename and (IMAGE_DIR / filename).exists():
+        return IMAGE_DIR / filename
+    return None
+
+# 最近ダウンロードに失敗した画像URLか
+def recently_failed(image_url):
+    return mirror_failures.get(make_cache_key(image_url)) is not None
+
+# 画像をダウンロードしてローカルに保存（保存済みなら何もしない、最近失敗したURLは再試行しない）
+# SQLite・ファイルの読み書きはスレッドで行い、イベントループを止めない
+async def mirror_image_async(image_url, http_client):
+    path = await asyncio.to_thread(local_image_path, image_url)
+    if path:
+        return path
+    if await asyncio.to_thread(recently_failed, image_url):
+        return None
+
+    try:
+        response = await http_client.get(image_url)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"Warning: Failed to download image {image_url}: {e}")
+        await mirror_failures.set_async(make_cache_key(image_url), True)
+        return None
+
+    content_type = response.headers.get("content-type", "").split(";")[0].strip()
+    return await asyncio.to_thread(_save_image, image_url, response.content, content_type)
+
+def _save_image(image_url, content, content_type):
+    filename = hashlib.sha256(content).hexdigest() + _EXTENSIONS.get(content_type, ".png")
+
+    IMAGE_DIR.mkdir(parents=True, exist_ok=True)
+    path = IMAGE_DIR / filename
+    if not path.exists():
+        # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+
+    image_mirror.set(make_cache_key(image_url), filename)
+    return path
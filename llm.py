@@ -0,0 +1,97 @@
+import os
+import asyncio
+import weakref
+import openai
+from openai import AsyncOpenAI
+from cache import SqliteCache, make_cache_key
+from scheduler import scheduler, PRIORITY_INTERACTIVE
+from story_context import count_tokens
+
+# チャット補完の共通レイヤー
+# 同じモデル・メッセージ・パラメータのリクエストはディスク上のキャッシュから返す
+
+COMPLETION_CACHE_TTL = int(os.getenv("EHON_COMPLETION_CACHE_TTL", str(7 * 24 * 60 * 60)))  # 秒
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("EHON_COMPLETION_CACHE_MAX_ENTRIES", "20000"))
+
+completion_cache = SqliteCache(
+    "completions",
+    ttl=COMPLETION_CACHE_TTL,
+    max_entries=COMPLETION_CACHE_MAX_ENTRIES
+)
+
+# 非同期クライアントはイベントループごとに保持する（ループをまたいで使い回さない）
+_async_clients = weakref.WeakKeyDictionary()
+
+def _get_async_client():
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = AsyncOpenAI(api_key=openai.api_key)
+    return _async_clients[loop]
+
+def _completion_key(model, messages, params):
+    return make_cache_key(model, messages, params)
+
+# レート制限用のトークン数の見積もり（プロンプト + 応答の上限）
+def _estimate_tokens(model, messages, params):
+    prompt_tokens = sum(count_tokens(message["content"], model) for message in messages)
+    return prompt_tokens + params.get("max_tokens", 500)
+
+# キャッシュにある応答が検証を通るか（検証を変える前にキャッシュした応答を使わないため）
+def _is_valid(validate, content):
+    if validate is None:
+        return True
+    try:
+        validate(content)
+    except Exception:
+        return False
+    return True
+
+def _record_usage(model, estimated_tokens, response):
+    if response.usage:
+        scheduler.record_usage("openai", model, estimated_tokens, response.usage.total_tokens)
+
+# チャット補完（同期）
+# cache=False を指定すると毎回APIを呼び出す（ランダム性が必要な呼び出し用）
+# priority はレート制限の待ち行列での優先度（scheduler.PRIORITY_*）
+# validate を渡すと応答を検証してからキャッシュする（例外を投げた応答はキャッシュせずにそのまま例外を返す）
+def chat_completion(model, messages, cache=True, priority=PRIORITY_INTERACTIVE, validate=None, **params):
+    key = _completion_key(model, messages, params)
+    if cache:
+        content = completion_cache.get(key)
+        if content is not None and _is_valid(validate, content):
+            return content
+
+    estimated_tokens = _estimate_tokens(model, messages, params)
+    scheduler.acquire("openai", model, estimated_tokens, priority)
+    response = openai.chat.completions.create(model=model, messages=messages, **params)
+    _record_usage(model, estimated_tokens, response)
+    content = response.choices[0].message.content
+    if validate:
+        validate(content)
+
+    if cache:
+        completion_cache.set(key, content)
+    return content
+
+# チャット補完（非同期）
+async def chat_completion_async(model, messages, cache=True, priority=PRIORITY_INTERACTIVE, validate=None, **params):
+    key = _completion_key(model, messages, params)
+    if cache:
+        content = await completion_cache.get_async(key)
+        if content is not None and _is_valid(validate, content):
+            return content
+
+    estimated_tokens = _estimate_tokens(model, messages, params)
+    await scheduler.acquire_async("openai", model, estimated_tokens, priority)
+    response = await _get_async_client().chat.completions.create(model=model, messages=messages, **params)
+    _record_usage(model, estimated_tokens, response)
+    content = response.choices[0].message.content
+    if validate:
+        validate(content)
+
+    if cache:
+        await completion_cache.set_async(key, content)
+    return content
+
+def cache_stats():
+    return completion_cache.stats()
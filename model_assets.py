@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import hashlib
+from pathlib import Path
+from huggingface_hub import HfApi, snapshot_download
+
+# モデルファイルの事前準備
+# ユーザーのリクエスト中にダウンロードが発生しないよう、起動前（または起動直後のバックグラウンド）に
+# 全モデルを取得してチェックサムを記録し、アプリからはローカルファイルだけを読み込む
+#
+# 使い方:
+#   python model_assets.py provision   # ダウンロードしてリビジョン（コミット）とチェックサムを記録
+#   python model_assets.py verify      # チェックサムを検証
+#   python model_assets.py check       # 実際にロード・ウォームアップして所要時間を表示
+
+MODEL_DIR = Path(os.getenv("EHON_MODEL_DIR", "models"))
+MANIFEST_PATH = MODEL_DIR / "manifest.json"
+
+BLIP_MODEL_NAME = "Salesforce/blip-image-captioning-base"
+BLIP_LOCAL_DIR = MODEL_DIR / "blip-image-captioning-base"
+BLIP_FILE_PATTERNS = ["*.json", "*.txt", "*.safetensors"]
+# 取得するリビジョン（コミットのハッシュ）
+# 未指定ならマニフェストに記録したもの、マニフェストもなければ provision 時点の最新のコミットを使い、マニフェストに記録する
+BLIP_REVISION = os.getenv("EHON_BLIP_REVISION")
+
+# spaCyモデルはリポジトリに同梱している
+SPACY_MODEL_DIR = Path(os.getenv("EHON_SPACY_MODEL_DIR", "en_core_web_sm"))
+
+# 1 の場合、ローカルにモデルが無ければダウンロードせずにエラーにする
+# マニフェストがある（provision 済みの）環境では既定で 1（リクエストの処理中にダウンロードしない）
+MODELS_OFFLINE = os.getenv("EHON_MODELS_OFFLINE", "1" if MANIFEST_PATH.exists() else "0") == "1"
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _checksums(directory):
+    directory = Path(directory)
+    return {
+        str(path.relative_to(directory)): _sha256(path)
+        for path in sorted(directory.rglob("*"))
+        if path.is_file() and ".cache" not in path.parts
+    }
+
+def _artifacts():
+    return {"blip": BLIP_LOCAL_DIR, "spacy": SPACY_MODEL_DIR}
+
+# 設定ファイルと重みファイル（途中で止まったダウンロードの空ファイルは除く）が揃っているか
+def is_blip_provisioned():
+    if not (BLIP_LOCAL_DIR / "config.json").exists():
+        return False
+    return any(path.stat().st_size > 0 for path in BLIP_LOCAL_DIR.glob("*.safetensors"))
+
+def _read_manifest():
+    return json.loads(MANIFEST_PATH.read_text()) if MANIFEST_PATH.exists() else {}
+
+# BLIPモデルをダウンロード（取得済みでチェックサムが一致すれば何もしない）
+# マニフェストがある場合は、読み込む前にチェックサムを照合する
+# ダウンロードはマニフェストに記録したリビジョンに固定する（上流の更新でチェックサムが変わらないように）
+def ensure_blip(revision=None, offline=None):
+    manifest = _read_manifest()
+    recorded_revision = manifest.get("revisions", {}).get("blip")
+    revision = revision or BLIP_REVISION or recorded_revision
+    offline = MODELS_OFFLINE if offline is None else offline
+
+    if not is_blip_provisioned():
+        problems = ["BLIPモデルがありません"]
+    elif revision != recorded_revision:
+        problems = [f"マニフェストと異なるリビジョンです（{recorded_revision} → {revision}）"]
+    else:
+        problems = _verify_artifact("blip", BLIP_LOCAL_DIR, manifest)
+    if not problems:
+        return BLIP_LOCAL_DIR
+    if offline:
+        raise FileNotFoundError(
+            f"BLIPモデルが見つからないか壊れています: {BLIP_LOCAL_DIR}（{'、'.join(problems)}）"
+            "（python model_assets.py provision を実行してください）"
+        )
+
+    print(f"Downloading {BLIP_MODEL_NAME}@{revision or 'main'} to {BLIP_LOCAL_DIR}...")
+    snapshot_download(
+        repo_id=BLIP_MODEL_NAME,
+        revision=revision,
+        local_dir=BLIP_LOCAL_DIR,
+        allow_patterns=BLIP_FILE_PATTERNS,
+        # 壊れたファイルが残っている場合は上書きする
+        force_download=is_blip_provisioned()
+    )
+    return BLIP_LOCAL_DIR
+
+# 全モデルを取得し、リビジョンとチェックサムをマニフェストに記録
+def provision():
+    revision = (
+        BLIP_REVISION
+        or _read_manifest().get("revisions", {}).get("blip")
+        or HfApi().model_info(BLIP_MODEL_NAME).sha
+    )
+    ensure_blip(revision, offline=False)
+    manifest = {name: _checksums(path) for name, path in _artifacts().items()}
+    manifest["revisions"] = {"blip": revision}
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    MANIFEST_PATH.write_text(json.dumps(manifest, indent=2, ensure_ascii=False))
+    return manifest
+
+# 1つのモデルのファイルをマニフェストのチェックサムと照合する（マニフェストが無ければ照合しない）
+def _verify_artifact(name, path, manifest=None):
+    if manifest is None:
+        if not MANIFEST_PATH.exists():
+            return []
+        manifest = json.loads(MANIFEST_PATH.read_text())
+
+    expected = manifest.get(name, {})
+    actual = _checksums(path) if Path(path).exists() else {}
+    problems = []
+    for filename, checksum in expected.items():
+        if filename not in actual:
+            problems.append(f"{name}: {filename} がありません")
+        elif actual[filename] != checksum:
+            problems.append(f"{name}: {filename} のチェックサムが一致しません")
+    return problems
+
+# マニフェストとチェックサムを照合し、一致しないファイルの一覧を返す
+def verify():
+    if not MANIFEST_PATH.exists():
+        return [f"マニフェストがありません: {MANIFEST_PATH}"]
+
+    manifest = json.loads(MANIFEST_PATH.read_text())
+    problems = []
+    for name, path in _artifacts().items():
+        problems += _verify_artifact(name, path, manifest)
+    return problems
+
+# モデルを実際にロード・ウォームアップして所要時間を表示
+def check():
+    import captioning
+    import text_analysis
+
+    start = time.perf_counter()
+    captioning.warm_up()
+    print(f"BLIP ready in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    text_analysis.get_nlp()
+    print(f"spaCy ready in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "provision"
+    if command == "provision":
+        provision()
+        print(f"Wrote {MANIFEST_PATH}")
+    elif command == "verify":
+        problems = verify()
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    elif command == "check":
+        check()
+    else:
+        sys.exit(f"unknown command: {command}")
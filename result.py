@@ -1,26 +1,33 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import json
 import streamlit as st
 import base64
 from pathlib import Path
+from google_clients import get_clients
+from sheets_writer import sheets_writer
 
 # Google Sheets APIの認証設定
+# 認証済みのクライアントはプロセス内で使い回す（google_clients.py）
 def authenticate_google_sheets(json_keyfile):
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(json_keyfile, scope)
-    client = gspread.authorize(credentials)
-    return client
+    with open(json_keyfile, encoding="utf-8") as f:
+        service_account_info = json.load(f)
+    return get_clients(service_account_info)
+
+def _open_worksheet(spreadsheet_name, sheet_name, json_keyfile):
+    clients = authenticate_google_sheets(json_keyfile)
+    return clients.worksheet(clients.spreadsheet_by_name(spreadsheet_name), sheet_name)
 
 # スプレッドシートにデータを保存
+# 他の書き込みとまとめて追記する（書き込みが終わるまで待つ）
 def save_to_google_sheets(spreadsheet_name, sheet_name, data, json_keyfile):
-    client = authenticate_google_sheets(json_keyfile)
-    sheet = client.open(spreadsheet_name).worksheet(sheet_name)
-    sheet.append_row(data)  # 1行を追加
+    sheets_writer.append(
+        (json_keyfile, spreadsheet_name, sheet_name),
+        lambda: _open_worksheet(spreadsheet_name, sheet_name, json_keyfile),
+        [data]  # 1行を追加
+    ).result()
 
 # スプレッドシートからデータを取得
 def get_data_from_google_sheets(spreadsheet_name, sheet_name, json_keyfile):
-    client = authenticate_google_sheets(json_keyfile)
-    sheet = client.open(spreadsheet_name).worksheet(sheet_name)
+    sheet = _open_worksheet(spreadsheet_name, sheet_name, json_keyfile)
     return sheet.get_all_records()  # 全データを取得
 
 # 背景画像設定
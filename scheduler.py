@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+
+# 優先度（数値が小さいほど先に処理する）
+PRIORITY_INTERACTIVE = 0  # Bフローの各ステップなど、画面の前でユーザーが待っている呼び出し
+PRIORITY_STORY = 1        # 絵本本文の生成
+PRIORITY_BULK = 2         # ページ画像・画像プロンプトなどの一括処理
+
+# プロバイダー・モデルごとの上限（rpm: 1分あたりのリクエスト数, tpm: 1分あたりのトークン数）
+# モデル名 "*" はそのプロバイダーの既定値
+# 環境変数 EHON_RATE_LIMITS に {"openai/gpt-4": {"rpm": 500, "tpm": 10000}} の形式で上書きできる
+DEFAULT_RATE_LIMITS = {
+    "openai/gpt-4": {"rpm": 500, "tpm": 10000},
+    "openai/gpt-4o": {"rpm": 500, "tpm": 30000},
+    "openai/*": {"rpm": 500, "tpm": 30000},
+    "ideogram/*": {"rpm": 20},
+}
+
+# 非同期の待機者が空きを確認する間隔（秒）
+ASYNC_POLL_INTERVAL = 0.05
+
+def load_rate_limits():
+    limits = dict(DEFAULT_RATE_LIMITS)
+    limits.update(json.loads(os.getenv("EHON_RATE_LIMITS", "{}")))
+    return limits
+
+
+# トークンバケット（1分あたり limit 個のペースで補充し、最大 limit 個まで貯まる）
+class TokenBucket:
+    def __init__(self, limit_per_minute):
+        self.capacity = limit_per_minute
+        self.rate = limit_per_minute / 60.0
+        self.tokens = float(limit_per_minute)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # amount 個取り出せるまでの待ち時間（秒）
+    def wait_time(self, amount):
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "enqueued_at")
+
+    def __init__(self, priority, seq, tokens):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# プロバイダー・モデルごとの待ち行列とバケット
+class _Lane:
+    def __init__(self, limits):
+        self.requests = TokenBucket(limits["rpm"]) if limits.get("rpm") else None
+        self.tokens = TokenBucket(limits["tpm"]) if limits.get("tpm") else None
+        self.queue = []
+
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+# プロセス全体で共有するレート制限スケジューラー
+# 同じプロバイダー・モデルへの呼び出しは優先度順（同じ優先度なら到着順）に、
+# 1分あたりのリクエスト数・トークン数の上限を超えないように送り出す
+class RateLimitScheduler:
+    def __init__(self, limits=None):
+        self.limits = limits or load_rate_limits()
+        self._cond = threading.Condition()
+        self._lanes = {}
+        self._seq = itertools.count()
+
+    def _lane(self, provider, model):
+        key = f"{provider}/{model}"
+        if key not in self._lanes:
+            limits = self.limits.get(key) or self.limits.get(f"{provider}/*") or {}
+            self._lanes[key] = _Lane(limits)
+        return self._lanes[key]
+
+    def _enqueue(self, lane, tokens, priority):
+        waiter = _Waiter(priority, next(self._seq), tokens)
+        heapq.heappush(lane.queue, waiter)
+        return waiter
+
+    def _dequeue(self, lane, waiter):
+        if waiter in lane.queue:
+            lane.queue.remove(waiter)
+            heapq.heapify(lane.queue)
+            self._cond.notify_all()
+
+    # 先頭の待機者であり、バケットに空きがあれば取り出す
+    # 取り出せた場合は 0、取り出せない場合は次に確認するまでの秒数を返す
+    def _try_grant(self, lane, waiter):
+        if lane.queue[0] is not waiter:
+            return 1.0
+
+        now = time.monotonic()
+        wait = 0.0
+        if lane.requests:
+            lane.requests.refill(now)
+            wait = max(wait, lane.requests.wait_time(1))
+        token_amount = 0
+        if lane.tokens:
+            lane.tokens.refill(now)
+            token_amount = min(waiter.tokens, lane.tokens.capacity)
+            wait = max(wait, lane.tokens.wait_time(token_amount))
+        if wait > 0:
+            return wait
+
+        if lane.requests:
+            lane.requests.tokens -= 1
+        if lane.tokens:
+            lane.tokens.tokens -= token_amount
+
+        heapq.heappop(lane.queue)
+        waited = now - waiter.enqueued_at
+        lane.granted += 1
+        lane.total_wait += waited
+        lane.max_wait = max(lane.max_wait, waited)
+        self._cond.notify_all()
+        return 0.0
+
+    # 送信枠を確保する（同期版、確保できるまでブロック）
+    def acquire(self, provider, model, tokens=0, priority=PRIORITY_BULK):
+        with self._cond:
+            lane = self._lane(provider, model)
+            waiter = self._enqueue(lane, tokens, priority)
+            try:
+                while True:
+                    wait = self._try_grant(lane, waiter)
+                    if wait == 0:
+                        return
+                    self._cond.wait(wait)
+            except BaseException:
+                self._dequeue(lane, waiter)
+                raise
+
+    # 送信枠を確保する（非同期版、イベントループをブロックしない）
+    async def acquire_async(self, provider, model, tokens=0, priority=PRIORITY_BULK):
+        with self._cond:
+            lane = self._lane(provider, model)
+            waiter = self._enqueue(lane, tokens, priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_grant(lane, waiter)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait, ASYNC_POLL_INTERVAL))
+        except BaseException:
+            with self._cond:
+                self._dequeue(lane, waiter)
+            raise
+
+    # 実際に使ったトークン数で見積もりとの差を補正する
+    def record_usage(self, provider, model, estimated_tokens, actual_tokens):
+        with self._cond:
+            lane = self._lane(provider, model)
+            if lane.tokens:
+                lane.tokens.tokens -= actual_tokens - estimated_tokens
+
+    # 待ち行列の長さと待ち時間
+    def stats(self):
+        with self._cond:
+            return {
+                key: {
+                    "queue_depth": len(lane.queue),
+                    "granted": lane.granted,
+                    "avg_wait": lane.total_wait / lane.granted if lane.granted else 0.0,
+                    "max_wait": lane.max_wait,
+                }
+                for key, lane in self._lanes.items()
+            }
+
+
+scheduler = RateLimitScheduler()
@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+from pathlib import Path
+
+# キャプション生成バックエンドのベンチマーク
+# バックエンドごとに別プロセスで計測し、レイテンシ・ピークメモリ（RSS）・
+# fp32とのキャプション一致率を比較する
+#
+# 使い方:
+#   python scripts/bench_caption.py path/to/drawings --backends fp32 int8 onnx --threads 4
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+def list_images(image_dir):
+    return sorted(p for p in Path(image_dir).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+# 1つのバックエンドを計測（子プロセス側）
+def run_worker(backend, image_dir, repeat):
+    sys.path.insert(0, str(ROOT_DIR))
+    from PIL import Image
+    import captioning
+
+    images = [Image.open(path).convert("RGB") for path in list_images(image_dir)]
+
+    start = time.perf_counter()
+    captioning.get_blip(backend)
+    load_time = time.perf_counter() - start
+
+    # ウォームアップ
+    captioning.generate_captions(images[:1], backend=backend)
+
+    latencies = []
+    captions = []
+    for _ in range(repeat):
+        captions = []
+        for image in images:
+            start = time.perf_counter()
+            captions.append(captioning.generate_captions([image], backend=backend)[0])
+            latencies.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        "backend": backend,
+        "load_time": load_time,
+        "latencies": latencies,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "captions": captions,
+    }, ensure_ascii=False))
+
+def word_overlap(a, b):
+    a, b = set(a.lower().split()), set(b.lower().split())
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def main():
+    parser = argparse.ArgumentParser(description="BLIPキャプション生成バックエンドのベンチマーク")
+    parser.add_argument("image_dir", help="サンプル画像（描いた絵）のディレクトリ")
+    parser.add_argument("--backends", nargs="+", default=["fp32", "int8", "onnx"])
+    parser.add_argument("--threads", type=int, default=0, help="推論スレッド数（0は既定値）")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.image_dir, args.repeat)
+        return
+
+    if not list_images(args.image_dir):
+        sys.exit(f"画像が見つかりません: {args.image_dir}")
+
+    env = dict(os.environ, EHON_CAPTION_THREADS=str(args.threads), EHON_CAPTION_SERVER="")
+    backends = ["fp32"] + [b for b in args.backends if b != "fp32"]
+
+    results = {}
+    for backend in backends:
+        print(f"Benchmarking {backend}...", file=sys.stderr)
+        output = subprocess.run(
+            [sys.executable, __file__, args.image_dir, "--worker", backend, "--repeat", str(args.repeat)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+
+    baseline = results["fp32"]["captions"]
+    print(f"{'backend':<8} {'load[s]':>8} {'p50[ms]':>8} {'p95[ms]':>8} {'peakRSS[MB]':>12} {'exact':>6} {'overlap':>8}")
+    for backend, result in results.items():
+        captions = result["captions"]
+        exact = sum(a == b for a, b in zip(captions, baseline)) / len(baseline)
+        overlap = sum(word_overlap(a, b) for a, b in zip(captions, baseline)) / len(baseline)
+        print(
+            f"{backend:<8} {result['load_time']:>8.2f} "
+            f"{1000 * percentile(result['latencies'], 0.5):>8.0f} {1000 * percentile(result['latencies'], 0.95):>8.0f} "
+            f"{result['peak_rss_mb']:>12.0f} {exact:>6.0%} {overlap:>8.2f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+from pathlib import Path
+
+# spaCyパイプラインのベンチマーク
+# 全コンポーネントを読み込む場合（full）と、品詞タグ付けに必要なものだけを読み込む場合（trimmed）で
+# ロード時間・メモリ増加量・名詞抽出の処理時間を比較する
+#
+# 使い方:
+#   python scripts/bench_spacy.py --repeat 50
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+SAMPLE_CAPTIONS = [
+    "a drawing of a cat sitting under a tree",
+    "a child's drawing of a house with a red roof and a sun",
+    "a picture of a dog playing with a ball in the park",
+    "a cartoon of a girl holding a balloon next to a rainbow",
+    "a painting of a boat on the sea with birds in the sky",
+    "a drawing of a dinosaur and a flower in a garden",
+    "a sketch of a rabbit eating a carrot",
+    "a colorful drawing of a train going over a bridge",
+]
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# 1つのパイプラインを計測（子プロセス側）
+def run_worker(variant, repeat):
+    sys.path.insert(0, str(ROOT_DIR))
+    import spacy
+    import text_analysis
+
+    baseline_rss = rss_mb()
+    exclude = text_analysis.SPACY_EXCLUDE if variant == "trimmed" else []
+
+    start = time.perf_counter()
+    nlp = spacy.load(text_analysis.SPACY_MODEL_DIR, exclude=exclude)
+    load_time = time.perf_counter() - start
+    load_rss = rss_mb() - baseline_rss
+
+    texts = SAMPLE_CAPTIONS * repeat
+
+    start = time.perf_counter()
+    for text in texts:
+        nlp(text)
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    docs = list(nlp.pipe(texts, batch_size=32))
+    batch_time = time.perf_counter() - start
+
+    print(json.dumps({
+        "variant": variant,
+        "pipeline": nlp.pipe_names,
+        "load_time": load_time,
+        "load_rss_mb": load_rss,
+        "single_ms_per_text": 1000 * single_time / len(texts),
+        "batch_ms_per_text": 1000 * batch_time / len(texts),
+        "nouns": [[t.text for t in doc if t.pos_ == "NOUN"] for doc in docs[:len(SAMPLE_CAPTIONS)]],
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description="spaCyパイプラインのロード時間・メモリのベンチマーク")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.repeat)
+        return
+
+    results = {}
+    for variant in ["full", "trimmed"]:
+        output = subprocess.run(
+            [sys.executable, __file__, "--worker", variant, "--repeat", str(args.repeat)],
+            cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        results[variant] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"{'variant':<8} {'load[s]':>8} {'loadRSS[MB]':>12} {'nlp()[ms]':>10} {'pipe()[ms]':>11}  pipeline")
+    for variant, result in results.items():
+        print(
+            f"{variant:<8} {result['load_time']:>8.2f} {result['load_rss_mb']:>12.0f} "
+            f"{result['single_ms_per_text']:>10.2f} {result['batch_ms_per_text']:>11.2f}  {', '.join(result['pipeline'])}"
+        )
+
+    full, trimmed = results["full"], results["trimmed"]
+    print(f"load time saved: {full['load_time'] - trimmed['load_time']:.2f}s, "
+          f"memory saved: {full['load_rss_mb'] - trimmed['load_rss_mb']:.0f}MB, "
+          f"same nouns: {full['nouns'] == trimmed['nouns']}")
+
+if __name__ == "__main__":
+    main()
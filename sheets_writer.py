@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+from concurrent.futures import Future
+
+# Google スプレッドシートへの書き込みをまとめるライター（group commit）
+# 書き込み先のワークシートごとに書き込み用のスレッドを1つ持つ
+# 書き込み中でなければ追記はすぐに書き込み、書き込み中に届いた追記は溜めておいて、
+# 書き込みが終わった直後に1回の append_rows でまとめて書き込む（待ち時間を設けずにAPI呼び出しをまとめる）
+#
+# 例:
+#   future = sheets_writer.append(("spreadsheet-id", "GeneratedBooks"), open_worksheet, rows)
+#   first_row, last_row = future.result()  # 書き込まれた行の範囲
+
+MAX_BATCH_ROWS = int(os.getenv("EHON_SHEETS_MAX_BATCH_ROWS", "500"))
+
+class _Request:
+    __slots__ = ("rows", "future", "enqueued_at")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+# 書き込み先ごとの待ち行列
+class _Target:
+    def __init__(self, open_worksheet, value_input_option):
+        self.open_worksheet = open_worksheet
+        self.value_input_option = value_input_option
+        self.worksheet = None
+        self.pending = []
+        self.pending_rows = 0
+        self.thread = None
+        self.writing = False
+
+        self.batches = 0
+        self.requests = 0
+        self.rows = 0
+        self.errors = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.total_wait = 0.0
+
+class GroupCommitWriter:
+    def __init__(self, max_batch_rows=MAX_BATCH_ROWS):
+        self.max_batch_rows = max_batch_rows
+        self._cond = threading.Condition()
+        self._targets = {}
+
+    # 行を追記する（書き込みはバックグラウンドでまとめて行う）
+    # key: 書き込み先を表す値（同じワークシートには同じ値を使う）
+    # open_worksheet: ワークシート（gspread.Worksheet）を開く関数
+    # 戻り値: 書き込まれた行の範囲 (最初の行, 最後の行) を返す Future
+    def append(self, key, open_worksheet, rows, value_input_option="RAW"):
+        request = _Request([list(row) for row in rows])
+        if not request.rows:
+            request.future.set_result(None)
+            return request.future
+
+        with self._cond:
+            target_key = (key, value_input_option)
+            target = self._targets.get(target_key)
+            if target is None:
+                target = self._targets[target_key] = _Target(open_worksheet, value_input_option)
+            target.pending.append(request)
+            target.pending_rows += len(request.rows)
+
+            if target.thread is None:
+                target.thread = threading.Thread(target=self._run, args=(target,), name="sheets-writer", daemon=True)
+                target.thread.start()
+            self._cond.notify_all()
+        return request.future
+
+    # 溜まっている行をすべて書き込むまで待つ
+    def flush(self):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: all(not target.pending and not target.writing for target in self._targets.values())
+            )
+
+    # 書き込み先ごとのスレッド（同じワークシートへの書き込みは常に1つだけ）
+    def _run(self, target):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: target.pending)
+                target.writing = True
+            try:
+                self._flush_target(target)
+            finally:
+                with self._cond:
+                    target.writing = False
+                    self._cond.notify_all()
+
+    # 上限件数ずつ取り出して書き込む（1つの追記の行は分割しない）
+    def _take_batch(self, target):
+        with self._cond:
+            batch, size = [], 0
+            while target.pending:
+                request = target.pending[0]
+                if batch and size + len(request.rows) > self.max_batch_rows:
+                    break
+                batch.append(target.pending.pop(0))
+                size += len(request.rows)
+            target.pending_rows -= size
+            return batch
+
+    def _flush_target(self, target):
+        while True:
+            batch = self._take_batch(target)
+            if not batch:
+                return
+            self._write_batch(target, batch)
+
+    def _write_batch(self, target, batch):
+        rows = [row for request in batch for row in request.rows]
+        start = time.monotonic()
+        try:
+            if target.worksheet is None:
+                target.worksheet = target.open_worksheet()
+            response = target.worksheet.append_rows(rows, value_input_option=target.value_input_option)
+        except Exception as e:
+            # 次回はワークシートを開き直す
+            target.worksheet = None
+            with self._cond:
+                target.errors += 1
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        elapsed = time.monotonic() - start
+        with self._cond:
+            target.batches += 1
+            target.requests += len(batch)
+            target.rows += len(rows)
+            target.total_flush_time += elapsed
+            target.max_flush_time = max(target.max_flush_time, elapsed)
+            target.total_wait += sum(start - request.enqueued_at for request in batch)
+
+        # 各追記の行範囲を、まとめて書き込んだ範囲から割り当てる
+        first = _first_row(response)
+        for request in batch:
+            last = first + len(request.rows) - 1 if first is not None else None
+            request.future.set_result((first, last) if first is not None else None)
+            if first is not None:
+                first = last + 1
+
+    # 書き込み先ごとのバッチの充填率・書き込み時間
+    def stats(self):
+        with self._cond:
+            return {
+                str(target_key): {
+                    "pending_rows": target.pending_rows,
+                    "batches": target.batches,
+                    "rows": target.rows,
+                    "errors": target.errors,
+                    "avg_batch_rows": target.rows / target.batches if target.batches else 0.0,
+                    "avg_batch_fill": target.rows / (target.batches * self.max_batch_rows) if target.batches else 0.0,
+                    "avg_flush_latency": target.total_flush_time / target.batches if target.batches else 0.0,
+                    "max_flush_latency": target.max_flush_time,
+                    "avg_queue_wait": target.total_wait / target.requests if target.requests else 0.0,
+                }
+                for target_key, target in self._targets.items()
+            }
+
+# 追記結果の範囲（例: "GeneratedBooks!A120:D124"）の最初の行
+def _first_row(response):
+    try:
+        updated_range = response["updates"]["updatedRange"]
+    except (KeyError, TypeError):
+        return None
+    cell = updated_range.split("!")[-1].split(":")[0]
+    digits = "".join(ch for ch in cell if ch.isdigit())
+    return int(digits) if digits else None
+
+
+sheets_writer = GroupCommitWriter()
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# 依存関係つきの処理ステージをスレッドプールで実行する
+# 依存するステージがすべて終わったものから順に投入するため、互いに独立したステージは並行して動く
+# 各ステージの関数は、依存するステージの結果をキーワード引数（ステージ名）で受け取る
+#
+# 例:
+#   graph = StageGraph()
+#   graph.add("caption", lambda: ...)
+#   graph.add("labels", lambda: ...)
+#   graph.add("nouns", lambda caption, labels: ..., depends_on=["caption", "labels"])
+#   run = graph.start()
+#   results = run.result()  # {"caption": ..., "labels": ..., "nouns": ...}
+
+STAGE_MAX_WORKERS = int(os.getenv("EHON_STAGE_MAX_WORKERS", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# 全セッションで共有するスレッドプール
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=STAGE_MAX_WORKERS, thread_name_prefix="stage")
+        return _executor
+
+class StageGraph:
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, func, depends_on=()):
+        if name in self.stages:
+            raise ValueError(f"ステージ {name} は登録済みです")
+        unknown = [dep for dep in depends_on if dep not in self.stages]
+        if unknown:
+            raise ValueError(f"ステージ {name} の依存先が登録されていません: {', '.join(unknown)}")
+        self.stages[name] = (func, tuple(depends_on))
+        return self
+
+    # 実行を開始してすぐに戻る（結果は StageRun.result で待つ）
+    def start(self, executor=None):
+        return StageRun(self, executor or get_executor())
+
+class StageRun:
+    def __init__(self, graph, executor):
+        self.stages = dict(graph.stages)
+        self.executor = executor
+        self.results = {}
+        self.timings = {}  # ステージ名 → {"start": 開始までの秒数, "duration": 処理時間}
+        self.elapsed = None
+        self.future = Future()
+
+        self._lock = threading.Lock()
+        self._remaining = {name: len(deps) for name, (_, deps) in self.stages.items()}
+        self._dependents = {name: [] for name in self.stages}
+        for name, (_, deps) in self.stages.items():
+            for dep in deps:
+                self._dependents[dep].append(name)
+        self._pending = len(self.stages)
+        self._started_at = time.perf_counter()
+
+        if not self.stages:
+            self.elapsed = 0.0
+            self.future.set_result({})
+        for name, remaining in self._remaining.items():
+            if remaining == 0:
+                self.executor.submit(self._run_stage, name)
+
+    def _run_stage(self, name):
+        # 他のステージが失敗していれば実行しない
+        if self.future.done():
+            return
+
+        func, deps = self.stages[name]
+        start = time.perf_counter()
+        try:
+            result = func(**{dep: self.results[dep] for dep in deps})
+        except BaseException as e:
+            self._record_timing(name, start)
+            with self._lock:
+                if not self.future.done():
+                    self.elapsed = time.perf_counter() - self._started_at
+                    self.future.set_exception(e)
+            return
+        self._record_timing(name, start)
+
+        ready = []
+        with self._lock:
+            self.results[name] = result
+            self._pending -= 1
+            for dependent in self._dependents[name]:
+                self._remaining[dependent] -= 1
+                if self._remaining[dependent] == 0:
+                    ready.append(dependent)
+            finished = self._pending == 0
+
+        if finished:
+            self.elapsed = time.perf_counter() - self._started_at
+            self.future.set_result(dict(self.results))
+        for dependent in ready:
+            self.executor.submit(self._run_stage, dependent)
+
+    def _record_timing(self, name, start):
+        self.timings[name] = {
+            "start": start - self._started_at,
+            "duration": time.perf_counter() - start,
+        }
+
+    # 全ステージの結果を待つ（失敗したステージがあればその例外を送出）
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    def failed(self):
+        return self.future.done() and self.future.exception() is not None
+
+    # ステージごとの所要時間
+    def report(self):
+        lines = [
+            f"{name}: start {timing['start']:.2f}s, {timing['duration']:.2f}s"
+            for name, timing in sorted(self.timings.items(), key=lambda item: item[1]["start"])
+        ]
+        if self.elapsed is not None:
+            lines.append(f"total: {self.elapsed:.2f}s")
+        return "\n".join(lines)
@@ -0,0 +1,480 @@
+import os
+import re
+import csv
+import random
+import sys
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from cache import SqliteCache, LruCache, make_cache_key
+from sheets_writer import sheets_writer
+import gspread
+from google_clients import get_clients
+
+# 絵本データの保存先
+# プロンプト（DBタブ）・絵本情報（sheet1）・絵本のページ（GeneratedBooksタブ）の読み書きをまとめ、
+# Google スプレッドシートとローカルのSQLiteを切り替えられるようにする
+#
+# EHON_STORAGE_BACKEND: "sheets"（既定） / "sqlite"
+# EHON_WRITE_BEHIND=1: 絵本のページの書き込みをバックグラウンドで行う（write_behind.py）
+#
+# ローカル（SQLite）のプロンプトは、DBタブをCSVで書き出したものから取り込む:
+#   python storage.py import-prompts prompts.csv
+
+STORAGE_BACKEND = os.getenv("EHON_STORAGE_BACKEND", "sheets")
+SQLITE_PATH = Path(os.getenv("EHON_SQLITE_PATH", "data/ehon.sqlite3"))
+
+PROMPT_RANGE = "DB!A:G"
+BOOKS_WORKSHEET = "GeneratedBooks"
+BOOKS_HEADER = ["絵本ID", "ページ番号", "ページの話", "IdeogramのURL"]
+
+# 絵本IDの払い出し
+# GeneratedBooksを読まずにIDを決めるため、IDの範囲（ブロック）をまとめて借りて、プロセス内で順に使う
+# ブロックは BookIdLeasesタブへの行の追記で借りる。追記された行番号は同時に追記しても重ならないので、
+# 行番号から決まる範囲は他のプロセスと重複しない
+# 使われずにプロセスが終了したIDは欠番になる
+# EHON_BOOK_ID_BLOCK_SIZE はBookIdLeasesタブを作成するときだけ使う（以後は1行目の値を使う）
+BOOK_ID_LEASES_WORKSHEET = "BookIdLeases"
+BOOK_ID_BLOCK_SIZE = int(os.getenv("EHON_BOOK_ID_BLOCK_SIZE", "10"))
+
+# 絵本の読み込み
+# 絵本ID → GeneratedBooksの行範囲 の索引から、該当する行だけを取得する
+# 索引はスプレッドシートの BookIndexタブに置き、全プロセスで共有する（再起動しても失われない）
+# 絵本 Ehon-N の行範囲は N+1 行目に書くため、索引も1行読むだけで引ける
+# 索引にない絵本（索引を作る前に保存したものなど）はA列だけを読んで探し、見つかれば索引に書き足す
+# 索引の内容と最近表示した絵本はプロセス内にも保持し、スプレッドシートを読まずに返す
+BOOK_INDEX_WORKSHEET = "BookIndex"
+BOOK_INDEX_HEADER = ["絵本ID", "最初の行", "最後の行"]
+BOOK_INDEX_GROW_ROWS = 1000
+BOOK_INDEX_MAX_ENTRIES = int(os.getenv("EHON_BOOK_INDEX_MAX_ENTRIES", "200000"))
+HOT_BOOKS_MAX_ENTRIES = int(os.getenv("EHON_HOT_BOOKS_MAX_ENTRIES", "256"))
+# 見つからなかった絵本IDは、この時間（秒）はスプレッドシートを読まずに空のリストを返す
+MISSING_BOOK_TTL = float(os.getenv("EHON_MISSING_BOOK_TTL", "60"))
+
+# 絵本情報（プロンプト）の項目（スプレッドシートの列順）
+STORY_ELEMENT_FIELDS = [
+    "maincharacter",
+    "maincharacter_name",
+    "location",
+    "theme",
+    "subcharacter_A",
+    "subcharacter_B",
+    "storyline",
+]
+
+BOOK_ID_PATTERN = re.compile(r"Ehon-(\d{5})")
+
+def format_book_id(number):
+    return f"Ehon-{number:05d}"
+
+# 追記結果の範囲（例: "BookIdLeases!A5:C5"）
+_UPDATED_RANGE_PATTERN = re.compile(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?")
+
+# 追記結果から追記された行の範囲 (最初の行, 最後の行) を取得
+def _updated_rows(response):
+    match = _UPDATED_RANGE_PATTERN.search(response["updates"]["updatedRange"])
+    first = int(match.group(1))
+    return first, int(match.group(2) or first)
+
+# 借りたIDのブロックから順にIDを払い出す（スレッドセーフ）
+# lease_block: 新しいブロックを借りて (最初の番号, 個数) を返す関数
+class BookIdBlock:
+    def __init__(self, lease_block):
+        self.lease_block = lease_block
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def next_id(self):
+        with self._lock:
+            if self._next >= self._end:
+                start, count = self.lease_block()
+                self._next, self._end = start, start + count
+            number = self._next
+            self._next += 1
+        return format_book_id(number)
+
+# 保存先の共通インターフェース
+# 行はスプレッドシートと同じ形（文字列のリスト）でやり取りする
+# - プロンプト: STORY_ELEMENT_FIELDS の順の7列
+# - 絵本のページ: [絵本ID, ページ番号, ページの話, 画像URL]
+class Storage(ABC):
+    # プロンプト（ヘッダーを除く）
+    @abstractmethod
+    def get_prompt_rows(self):
+        ...
+
+    # 生成した絵本情報を1行追記
+    @abstractmethod
+    def append_story_elements(self, row):
+        ...
+
+    # 次の絵本ID
+    @abstractmethod
+    def next_book_id(self):
+        ...
+
+    # 1冊分のページを追記
+    @abstractmethod
+    def append_book_pages(self, rows):
+        ...
+
+    # 絵本IDに対応するページ（見つからなければ空のリスト）
+    @abstractmethod
+    def get_book_pages(self, book_id):
+        ...
+
+# Google スプレッドシート
+class SheetsStorage(Storage):
+    def __init__(self, service_account_info, spreadsheet_id):
+        self.service_account_info = service_account_info
+        self.spreadsheet_id = spreadsheet_id
+        self._book_ids = BookIdBlock(self._lease_book_id_block)
+        self._lease_header = None
+        self._book_index = SqliteCache("book_index", max_entries=BOOK_INDEX_MAX_ENTRIES)
+        self._hot_books = LruCache(HOT_BOOKS_MAX_ENTRIES)
+        self._missing_books = LruCache(HOT_BOOKS_MAX_ENTRIES)  # 絵本ID → 見つからなかった時刻
+
+    # 認証済みのクライアント・開いたスプレッドシートはプロセス内で使い回す（google_clients.py）
+    def _spreadsheet(self):
+        return get_clients(self.service_account_info).spreadsheet(self.spreadsheet_id)
+
+    def _worksheet(self, title):
+        return get_clients(self.service_account_info).worksheet(self._spreadsheet(), title)
+
+    # GeneratedBooksタブを取得（なければ作成）
+    def _books_worksheet(self):
+        spreadsheet = self._spreadsheet()
+        try:
+            return self._worksheet(BOOKS_WORKSHEET)
+        except gspread.exceptions.WorksheetNotFound:
+            worksheet = spreadsheet.add_worksheet(title=BOOKS_WORKSHEET, rows=1000, cols=10)
+            worksheet.append_row(BOOKS_HEADER)
+            return worksheet
+
+    def get_prompt_rows(self):
+        rows = self._spreadsheet().values_get(PROMPT_RANGE).get("values", [])
+        return rows[1:] if len(rows) > 1 else []  # ヘッダーを除外
+
+    # 他のセッションの追記とまとめて書き込む（書き込みが終わるまで待つ）
+    def append_story_elements(self, row):
+        sheets_writer.append(
+            (self.spreadsheet_id, "sheet1"),
+            lambda: self._spreadsheet().sheet1,
+            [row],
+            value_input_option="USER_ENTERED"
+        ).result()
+
+    # 既存の絵本IDの最大値（BookIdLeasesタブを作るときに1回だけ使う）
+    def _max_book_number(self):
+        all_rows = self._books_worksheet().get_all_values()
+
+        # Ehon-XXXXX形式のIDだけを抽出
+        numbers = [int(match.group(1)) for row in all_rows if (match := BOOK_ID_PATTERN.match(row[0]))]
+        return max(numbers, default=0)
+
+    # BookIdLeasesタブを作成する
+    # 1行目（["base", 既存の絵本IDの最大値, "block_size", ブロックの大きさ]）はタブの追加と同じリクエストで書き込むため、
+    # 1行目のないタブが他のプロセスから見えることはない（作成中にプロセスが終了しても、タブごと作られない）
+    def _create_leases_worksheet(self):
+        spreadsheet = self._spreadsheet()
+        base = self._max_book_number()
+        sheet_id = random.randrange(1, 2**31 - 1)
+        header = [
+            {"userEnteredValue": {"stringValue": "base"}},
+            {"userEnteredValue": {"numberValue": base}},
+            {"userEnteredValue": {"stringValue": "block_size"}},
+            {"userEnteredValue": {"numberValue": BOOK_ID_BLOCK_SIZE}},
+        ]
+        spreadsheet.batch_update({"requests": [
+            {"addSheet": {"properties": {
+                "sheetId": sheet_id,
+                "title": BOOK_ID_LEASES_WORKSHEET,
+                "gridProperties": {"rowCount": 1000, "columnCount": 4},
+            }}},
+            {"updateCells": {
+                "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                "rows": [{"values": header}],
+                "fields": "userEnteredValue",
+            }},
+        ]})
+
+    # BookIdLeasesタブと、1行目の (起点となる番号, ブロックの大きさ) を取得（なければ作成）
+    # 2行目以降: 借りたブロック
+    # ブロックの大きさはタブの作成時に1行目に固定するため、プロセスごとに EHON_BOOK_ID_BLOCK_SIZE が違っても範囲は重ならない
+    def _leases_worksheet(self):
+        try:
+            worksheet = self._worksheet(BOOK_ID_LEASES_WORKSHEET)
+        except gspread.exceptions.WorksheetNotFound:
+            try:
+                self._create_leases_worksheet()
+            except gspread.exceptions.APIError:
+                # 他のプロセスが先に作成した
+                pass
+            worksheet = self._worksheet(BOOK_ID_LEASES_WORKSHEET)
+
+        if self._lease_header is None:
+            header = worksheet.get("A1:D1")
+            if not header or len(header[0]) < 4:
+                raise RuntimeError(f"{BOOK_ID_LEASES_WORKSHEET}タブの1行目（base, block_size）が見つかりません")
+            self._lease_header = int(header[0][1]), int(header[0][3])
+        return worksheet, self._lease_header
+
+    def _lease_book_id_block(self):
+        worksheet, (base, block_size) = self._leases_worksheet()
+        response = worksheet.append_row(
+            ["lease", block_size, time.strftime("%Y-%m-%d %H:%M:%S")],
+            value_input_option="RAW",
+            insert_data_option="INSERT_ROWS",
+            table_range="A1"
+        )
+        row_number, _ = _updated_rows(response)
+        # 2行目が最初のブロック
+        return base + (row_number - 2) * block_size + 1, block_size
+
+    # 次の絵本ID（GeneratedBooksは読まない）
+    def next_book_id(self):
+        return self._book_ids.next_id()
+
+    def _index_key(self, book_id):
+        return make_cache_key(self.spreadsheet_id, book_id)
+
+    # 索引に行範囲を登録（既に登録されていれば範囲を広げる）
+    def _index_rows(self, book_id, first, last):
+        key = self._index_key(book_id)
+        known = self._book_index.get(key)
+        if known:
+            first, last = min(first, known[0]), max(last, known[1])
+        self._book_index.set(key, [first, last])
+
+    # BookIndexタブを取得（なければ作成）
+    def _book_index_worksheet(self):
+        spreadsheet = self._spreadsheet()
+        try:
+            return self._worksheet(BOOK_INDEX_WORKSHEET)
+        except gspread.exceptions.WorksheetNotFound:
+            try:
+                worksheet = spreadsheet.add_worksheet(
+                    title=BOOK_INDEX_WORKSHEET, rows=BOOK_INDEX_GROW_ROWS, cols=len(BOOK_INDEX_HEADER)
+                )
+                worksheet.update(range_name="A1:C1", values=[BOOK_INDEX_HEADER])
+            except gspread.exceptions.APIError:
+                # 他のプロセスが先に作成した
+                pass
+            return self._worksheet(BOOK_INDEX_WORKSHEET)
+
+    # 共有の索引（BookIndexタブの N+1 行目）に行範囲を書き込む
+    # 書き込めなくてもページは保存されているので、警告だけ出す（読み込み時にA列から探して書き直す）
+    def _write_shared_index(self, book_id, first, last):
+        row = int(BOOK_ID_PATTERN.fullmatch(book_id).group(1)) + 1
+        try:
+            worksheet = self._book_index_worksheet()
+            if row > worksheet.row_count:
+                worksheet.add_rows(row - worksheet.row_count + BOOK_INDEX_GROW_ROWS)
+            worksheet.update(range_name=f"A{row}:C{row}", values=[[book_id, first, last]], value_input_option="RAW")
+        except Exception as e:
+            print(f"Warning: Failed to update {BOOK_INDEX_WORKSHEET} for {book_id}: {e}")
+
+    # 共有の索引から行範囲を読む（なければ None）
+    def _read_shared_index(self, book_id):
+        row = int(BOOK_ID_PATTERN.fullmatch(book_id).group(1)) + 1
+        try:
+            values = self._worksheet(BOOK_INDEX_WORKSHEET).get(f"A{row}:C{row}")
+        except gspread.exceptions.WorksheetNotFound:
+            return None
+        if not values or len(values[0]) < 3 or values[0][0] != book_id:
+            return None
+        try:
+            first, last = int(values[0][1]), int(values[0][2])
+        except ValueError:
+            return None
+        self._book_index.set(self._index_key(book_id), [first, last])
+        return first, last
+
+    # 1冊分のページを、他のセッションの追記とまとめて1回のAPI呼び出しで書き込む（書き込みが終わるまで待つ）
+    def append_book_pages(self, rows):
+        if not rows:
+            return
+        written = sheets_writer.append((self.spreadsheet_id, BOOKS_WORKSHEET), self._books_worksheet, rows).result()
+        for book_id in {row[0] for row in rows}:
+            if written and BOOK_ID_PATTERN.fullmatch(book_id):
+                self._index_rows(book_id, *written)
+                self._write_shared_index(book_id, *self._book_index.get(self._index_key(book_id)))
+            self._hot_books.delete(book_id)
+            self._missing_books.delete(book_id)
+
+    # GeneratedBooksの行範囲から絵本IDが一致する行を取得
+    # 同時に書き込まれた他の絵本の行が範囲内に混ざることがあるため、絵本IDで絞り込む
+    def _read_rows(self, worksheet, book_id, first, last):
+        rows = worksheet.get(f"A{first}:D{last}")
+        # 末尾の空のセルは省略されるので、列数をそろえる
+        rows = [row + [""] * (len(BOOKS_HEADER) - len(row)) for row in rows]
+        return [row for row in rows if row and row[0] == book_id]
+
+    # A列だけを読んで絵本の行範囲を探し、索引に登録する（共有の索引にない場合のみ）
+    def _find_rows(self, worksheet, book_id):
+        row_numbers = [number for number, value in enumerate(worksheet.col_values(1), 1) if value == book_id]
+        if not row_numbers:
+            return None
+        first, last = min(row_numbers), max(row_numbers)
+        self._book_index.set(self._index_key(book_id), [first, last])
+        self._write_shared_index(book_id, first, last)
+        return first, last
+
+    def get_book_pages(self, book_id):
+        # 形式が正しくない絵本ID（入力途中の "Ehon-" など）はスプレッドシートを読まない
+        book_id = book_id.strip()
+        if not BOOK_ID_PATTERN.fullmatch(book_id):
+            return []
+        book_data = self._hot_books.get(book_id)
+        if book_data is not None:
+            return book_data
+        missing_at = self._missing_books.get(book_id)
+        if missing_at is not None and time.monotonic() - missing_at < MISSING_BOOK_TTL:
+            return []
+
+        try:
+            worksheet = self._worksheet(BOOKS_WORKSHEET)
+        except gspread.exceptions.WorksheetNotFound:
+            # まだ1冊も保存されていない
+            self._missing_books.set(book_id, time.monotonic())
+            return []
+        book_data = []
+        rows = self._book_index.get(self._index_key(book_id))
+        if rows:
+            book_data = self._read_rows(worksheet, book_id, *rows)
+        if not book_data:
+            # このプロセスの索引にない（他のプロセスが書いた・再起動した）
+            rows = self._read_shared_index(book_id)
+            if rows:
+                book_data = self._read_rows(worksheet, book_id, *rows)
+        if not book_data:
+            # 共有の索引にない、または行が移動・削除されていた
+            rows = self._find_rows(worksheet, book_id)
+            if rows:
+                book_data = self._read_rows(worksheet, book_id, *rows)
+
+        if book_data:
+            self._hot_books.set(book_id, book_data)
+            self._missing_books.delete(book_id)
+        else:
+            self._missing_books.set(book_id, time.monotonic())
+        return book_data
+
+# ローカルのSQLite（1台で完結する構成・テストやベンチマーク用）
+# path に ":memory:" を指定するとメモリ上に作成する
+class SqliteStorage(Storage):
+    def __init__(self, path=SQLITE_PATH):
+        if str(path) != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+
+        columns = ", ".join(f"{field} TEXT NOT NULL DEFAULT ''" for field in STORY_ELEMENT_FIELDS)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS prompts (id INTEGER PRIMARY KEY, {columns})")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS story_elements (id INTEGER PRIMARY KEY, {columns}, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS book_pages ("
+            " book_id TEXT NOT NULL,"
+            " page_number INTEGER NOT NULL,"
+            " story TEXT NOT NULL,"
+            " image_url TEXT,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (book_id, page_number))"
+        )
+        # 最後に払い出した絵本IDの番号（初回は既存のページから引き継ぐ）
+        self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO counters (name, value)"
+            " SELECT 'book_id', COALESCE(MAX(CAST(SUBSTR(book_id, 6) AS INTEGER)), 0) FROM book_pages"
+            " WHERE book_id GLOB 'Ehon-[0-9][0-9][0-9][0-9][0-9]'"
+        )
+        self._conn.commit()
+
+    def _insert_elements(self, table, rows, extra=()):
+        fields = STORY_ELEMENT_FIELDS + [name for name, _ in extra]
+        placeholders = ", ".join("?" for _ in fields)
+        values = [
+            (list(row) + [""] * len(STORY_ELEMENT_FIELDS))[:len(STORY_ELEMENT_FIELDS)] + [value for _, value in extra]
+            for row in rows
+        ]
+        self._conn.executemany(f"INSERT INTO {table} ({', '.join(fields)}) VALUES ({placeholders})", values)
+
+    def get_prompt_rows(self):
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {', '.join(STORY_ELEMENT_FIELDS)} FROM prompts ORDER BY id").fetchall()
+        return [list(row) for row in rows]
+
+    # プロンプトをまとめて登録
+    def import_prompt_rows(self, rows):
+        with self._lock:
+            self._insert_elements("prompts", rows)
+            self._conn.commit()
+
+    def append_story_elements(self, row):
+        with self._lock:
+            self._insert_elements("story_elements", [row], extra=[("created_at", time.time())])
+            self._conn.commit()
+
+    # カウンターの更新と読み出しを1つのトランザクションで行うため、同じファイルを使う他のプロセスとも重ならない
+    def next_book_id(self):
+        with self._lock:
+            with self._conn:
+                self._conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'book_id'")
+                (number,) = self._conn.execute("SELECT value FROM counters WHERE name = 'book_id'").fetchone()
+        return format_book_id(number)
+
+    def append_book_pages(self, rows):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO book_pages (book_id, page_number, story, image_url, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(book_id, int(page_number), story, image_url, now) for book_id, page_number, story, image_url in rows]
+            )
+            self._conn.commit()
+
+    def get_book_pages(self, book_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT book_id, page_number, story, image_url FROM book_pages WHERE book_id = ? ORDER BY page_number",
+                (book_id,)
+            ).fetchall()
+        # スプレッドシートから読んだ場合と同じく文字列で返す
+        return [[book_id, str(page_number), story, image_url or ""] for book_id, page_number, story, image_url in rows]
+
+_storage = None
+_storage_lock = threading.Lock()
+
+# プロセス全体で共有する保存先
+def get_storage(service_account_info=None, spreadsheet_id=None):
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if STORAGE_BACKEND == "sqlite":
+                _storage = SqliteStorage()
+            elif STORAGE_BACKEND == "sheets":
+                _storage = SheetsStorage(service_account_info, spreadsheet_id)
+            else:
+                raise ValueError(f"不明な保存先です: {STORAGE_BACKEND}")
+
+            # 絵本のページはジャーナルに記録してからバックグラウンドで書き込む
+            from write_behind import WRITE_BEHIND, WriteBehindStorage
+            if WRITE_BEHIND:
+                _storage = WriteBehindStorage(_storage)
+        return _storage
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "import-prompts":
+        print("使い方: python storage.py import-prompts <CSVファイル>")
+        sys.exit(1)
+
+    with open(sys.argv[2], newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))[1:]  # ヘッダーを除外
+    SqliteStorage().import_prompt_rows(rows)
+    print(f"{len(rows)} 件のプロンプトを {SQLITE_PATH} に取り込みました")
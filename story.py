@@ -1,17 +1,91 @@
 import streamlit as st
 import os
-import requests
+import json
+import asyncio
+import queue
+import threading
+import weakref
 import openai
+from story_context import StoryContext, CONTEXT_TOKEN_BUDGET
+from llm import chat_completion_async
+from scheduler import scheduler, PRIORITY_STORY, PRIORITY_BULK
+import image_store
+from ideogram_client import IdeogramClient
 
 # 環境変数の読み込み
 
 OPENAI_API_KEY = st.secrets["api_keys"]["OPENAI_API_KEY"]
 IDEOGRAM_API_KEY = st.secrets["api_keys"]["IDEOGRAM_API_KEY"]
 
-# ストーリー生成
-def generate_page_story(main_character, main_character_name, theme, sub_characters, storyline, target_age, page_number, total_pages, previous_content=""):
-    openai.api_key = OPENAI_API_KEY
+# app.py側の同期クライアント（openai.chat.completions）でも同じキーを使う
+openai.api_key = OPENAI_API_KEY
+
+# Ideogram APIの通信設定
+IDEOGRAM_CONNECT_TIMEOUT = 10  # 秒
+IDEOGRAM_READ_TIMEOUT = 120  # 秒
+IDEOGRAM_MAX_RETRIES = 4
+
+# Ideogramの画像生成パラメータ（プロンプト以外）
+IMAGE_GENERATION_PARAMS = {
+    "aspect_ratio": "ASPECT_1_1",
+    "model": "V_2_TURBO",
+    "style_type": "DESIGN",
+    "negative_prompt": "text, watermark, logo, distorted features, unrelated elements"
+}
+
+# ストーリー本文の生成モード
+# "sequential": 1ページずつ生成（従来方式） / "outline": 1回のリクエストで全ページを生成
+STORY_MODE = os.getenv("EHON_STORY_MODE", "sequential")
+MAX_PAGE_CHARS = 100  # 1ページの最大文字数
+
+# 非同期処理の共通基盤
+# プロセス全体で1つのイベントループをバックグラウンドスレッドで回し、
+# 複数セッションの絵本生成を同じループ上で並行して進める
+_loop = None
+_loop_lock = threading.Lock()
+
+# Ideogramクライアントはイベントループごとに保持する（ループをまたいで使い回さない）
+# 通常は共有イベントループ上の1つを全セッションで使い回す
+_ideogram_clients = weakref.WeakKeyDictionary()
+
+# バックグラウンドで保存中の画像URL（同じ画像を重複して取得しないため）
+_mirroring = set()
+_mirroring_lock = threading.Lock()
+
+def get_event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="story-event-loop", daemon=True).start()
+        return _loop
 
+def submit(coro):
+    """コルーチンを共有イベントループに投入し、concurrent.futures.Future を返す"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+def run_sync(coro):
+    """同期コードからコルーチンを共有イベントループで実行し、結果を待つ"""
+    return submit(coro).result()
+
+def _get_ideogram_client():
+    loop = asyncio.get_running_loop()
+    if loop not in _ideogram_clients:
+        _ideogram_clients[loop] = IdeogramClient(
+            api_key=IDEOGRAM_API_KEY,
+            connect_timeout=IDEOGRAM_CONNECT_TIMEOUT,
+            read_timeout=IDEOGRAM_READ_TIMEOUT,
+            max_retries=IDEOGRAM_MAX_RETRIES,
+            scheduler=scheduler
+        )
+    return _ideogram_clients[loop]
+
+# Ideogramへのリクエスト数・リトライ数・レイテンシ
+def ideogram_metrics():
+    return [client.metrics() for client in list(_ideogram_clients.values())]
+
+# ストーリー生成
+async def generate_page_story_async(main_character, main_character_name, theme, sub_characters, storyline, target_age, page_number, total_pages, previous_content=""):
     if page_number == total_pages:
         ending_instruction = "このページでストーリーを完結させてください。"
     elif page_number == total_pages - 1:
@@ -33,19 +107,101 @@ def generate_page_story(main_character, main_character_name, theme, sub_characte
         f"{page_number}ページ目のストーリー（日本語で簡潔に書いてください）: {ending_instruction}"
     )
 
-    response = openai.chat.completions.create(
+    content = await chat_completion_async(
         model="gpt-4",
+        priority=PRIORITY_STORY,
         messages=[
             {"role": "system", "content": "あなたは日本語の幼児向け絵本作家です。やさしい語り口調で物語を話します。"},
             {"role": "user", "content": prompt}
         ]
     )
-    return response.choices[0].message.content.strip()
+    return content.strip()
 
-# 画像生成プロンプト作成
-def generate_image_prompt_from_story(story, main_character, theme, sub_characters):
-    openai.api_key = OPENAI_API_KEY
+def generate_page_story(main_character, main_character_name, theme, sub_characters, storyline, target_age, page_number, total_pages, previous_content=""):
+    return run_sync(generate_page_story_async(
+        main_character, main_character_name, theme, sub_characters, storyline,
+        target_age, page_number, total_pages, previous_content
+    ))
+
+# これまでのストーリーを要約（長い絵本で文脈のトークン数を一定に保つため）
+async def summarize_story_async(summary, pages, max_tokens):
+    prompt = (
+        f"以下は子供向け絵本のこれまでのあらすじと、その後に続くページです。\n"
+        f"登場人物・出来事・伏線を落とさずに、続きを書くために必要な内容を1つのあらすじにまとめてください。\n\n"
+        f"これまでのあらすじ:\n{summary or 'なし'}\n\n"
+        f"続くページ:\n" + "\n".join(pages)
+    )
+
+    content = await chat_completion_async(
+        model="gpt-4o",
+        priority=PRIORITY_STORY,
+        messages=[
+            {"role": "system", "content": "あなたは絵本の編集者です。物語のあらすじを簡潔にまとめます。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens
+    )
+    return content.strip()
+
+# 全ページのストーリーを1回のリクエストでまとめて生成（JSON形式）
+async def generate_book_pages_async(main_character, main_character_name, theme, sub_characters, storyline, target_age, total_pages):
+    prompt = (
+        f"あなたは{target_age}歳の子供向け絵本の作家です。子どもが分かるような簡単な言葉を使ってください。語り口調（ですます調）でお願いします。\n"
+        f"以下の情報をもとに、全{total_pages}ページの絵本のストーリーを作成してください。\n"
+        f"主役のキャラクター: {main_character} (名前: {main_character_name})\n"
+        f"テーマ: {theme}\n"
+        f"サブキャラクター: {', '.join(sub_characters)}\n"
+        f"ストーリー構成: {storyline}\n"
+        f"対象年齢: {target_age}歳\n"
+        f"禁止ワード：「次のページ」、「最後のページ」、「…。」は使わないでください。\n"
+        f"各ページの内容は80文字程度（最大{MAX_PAGE_CHARS}文字）にしてください。\n"
+        f"ページごとに次のページへ自然につながるようにし、{total_pages}ページ目でストーリーを完結させてください。\n\n"
+        f"出力は次のJSON形式のみとし、pagesには1ページ目から順に{total_pages}個の文字列を入れてください:\n"
+        f'{{"pages": ["1ページ目のストーリー", "2ページ目のストーリー", ...]}}'
+    )
+
+    content = await chat_completion_async(
+        model="gpt-4o",
+        priority=PRIORITY_STORY,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": "あなたは日本語の幼児向け絵本作家です。やさしい語り口調で物語を話します。"},
+            {"role": "user", "content": prompt}
+        ],
+        # 形式が正しくない応答はキャッシュしない（同じ入力で毎回失敗しないように）
+        validate=lambda content: _parse_book_pages(content, total_pages)
+    )
+    return [fit_page_length(str(page)) for page in _parse_book_pages(content, total_pages)]
+
+# 全ページのストーリーのJSONからページのリストを取り出す（形式が正しくなければ ValueError）
+def _parse_book_pages(content, total_pages):
+    try:
+        pages = json.loads(content).get("pages", [])
+    except (json.JSONDecodeError, AttributeError) as e:
+        raise ValueError(f"ストーリーのJSONを読み取れません: {e}") from e
+
+    if not isinstance(pages, list):
+        raise ValueError("ストーリーのJSONに pages のリストがありません")
+    if len(pages) != total_pages:
+        raise ValueError(f"ストーリーのページ数が一致しません（期待値: {total_pages}, 実際: {len(pages)}）")
+    return pages
+
+def generate_book_pages(main_character, main_character_name, theme, sub_characters, storyline, target_age, total_pages):
+    return run_sync(generate_book_pages_async(
+        main_character, main_character_name, theme, sub_characters, storyline, target_age, total_pages
+    ))
 
+# 1ページの文字数を上限以内に収める（上限を超えた場合は最後の「。」で区切る）
+def fit_page_length(page_story, max_chars=MAX_PAGE_CHARS):
+    page_story = page_story.strip()
+    if len(page_story) <= max_chars:
+        return page_story
+
+    cut = page_story.rfind("。", 0, max_chars)
+    return page_story[:cut + 1] if cut > 0 else page_story[:max_chars]
+
+# 画像生成プロンプト作成
+async def generate_image_prompt_from_story_async(story, main_character, theme, sub_characters):
     prompt = (
         f"You are an AI assistant specializing in creating illustration prompts for a consistent style children's book.\n"
         f"Based on the following story, craft a vivid, colorful, and child-friendly prompt for an illustration tool:\n\n"
@@ -57,39 +213,42 @@ def generate_image_prompt_from_story(story, main_character, theme, sub_character
         f"Ensure the style remains consistent with the book's other illustrations, featuring vibrant colors and whimsical elements suitable for children aged 5."
     )
 
-    response = openai.chat.completions.create(
+    content = await chat_completion_async(
         model="gpt-4",
+        priority=PRIORITY_BULK,
         messages=[
             {"role": "system", "content": "You specialize in generating detailed illustration prompts for AI tools."},
             {"role": "user", "content": prompt}
         ]
     )
-    return response.choices[0].message.content.strip()
+    return content.strip()
+
+def generate_image_prompt_from_story(story, main_character, theme, sub_characters):
+    return run_sync(generate_image_prompt_from_story_async(story, main_character, theme, sub_characters))
 
 # 画像生成
-def generate_image(prompt):
-    headers = {
-        "Api-Key": IDEOGRAM_API_KEY,
-        "Content-Type": "application/json",
-        "accept": "application/json"
-    }
+# 同じプロンプト・パラメータで生成済みの画像があれば再利用し、
+# 新しく生成した画像はローカルにも保存しておく（IdeogramのURLは期限切れになるため）
+async def generate_image_async(prompt):
+    cache_key = image_store.prompt_key(prompt, IMAGE_GENERATION_PARAMS)
+    cached_url = await image_store.get_cached_image_async(cache_key)
+    if cached_url:
+        return cached_url
 
-    payload = {
-        "image_request": {
-            "prompt": prompt,
-            "aspect_ratio": "ASPECT_1_1",
-            "model": "V_2_TURBO",
-            "style_type": "DESIGN",
-            "negative_prompt": "text, watermark, logo, distorted features, unrelated elements"
-        }
+    image_request = {
+        "prompt": prompt,
+        **IMAGE_GENERATION_PARAMS
     }
 
-    response = requests.post("https://api.ideogram.ai/generate", headers=headers, json=payload)
+    response = await _get_ideogram_client().generate(image_request, priority=PRIORITY_BULK)
 
     if response.status_code == 200:
         data = response.json()
         if 'data' in data and data['data']:
-            return data['data'][0]['url']
+            image_url = data['data'][0]['url']
+            if await image_store.mirror_image_async(image_url, _get_ideogram_client()):
+                await image_store.cache_image_async(cache_key, image_url)
+            return image_url
         else:
             print("Warning: No data found for the generated image.")
             return None
@@ -98,36 +257,147 @@ def generate_image(prompt):
         print(f"Response Content: {response.text}")
         return None
 
+def generate_image(prompt):
+    return run_sync(generate_image_async(prompt))
+
+# 表示用の画像ソース（ローカルに保存済みならそのパス、未保存なら取得を試み、失敗したらURLのまま）
+async def get_image_source_async(image_url):
+    path = await image_store.mirror_image_async(image_url, _get_ideogram_client())
+    return str(path) if path else image_url
+
+# 画面の描画を止めないよう、未保存の画像はバックグラウンドで保存を始めてURLのまま返す
+# （次に表示するときからローカルの画像を使う）
+def get_image_source(image_url):
+    path = image_store.local_image_path(image_url)
+    if path:
+        return str(path)
+    if not image_store.recently_failed(image_url):
+        with _mirroring_lock:
+            if image_url not in _mirroring:
+                _mirroring.add(image_url)
+                submit(get_image_source_async(image_url)).add_done_callback(
+                    lambda _: _discard_mirroring(image_url)
+                )
+    return image_url
+
+def _discard_mirroring(image_url):
+    with _mirroring_lock:
+        _mirroring.discard(image_url)
+
+# 1ページ分の画像生成（画像プロンプト作成 → 画像生成）
+async def generate_page_image_async(page_story, main_character, theme, sub_characters):
+    image_prompt = await generate_image_prompt_from_story_async(
+        story=page_story,
+        main_character=main_character,
+        theme=theme,
+        sub_characters=sub_characters
+    )
+    return await generate_image_async(image_prompt)
+
 # ストーリーと画像の生成フロー
-def generate_full_story_and_images(main_character, main_character_name, theme, sub_characters, storyline, target_age, num_pages):
+# sequential モードではストーリー本文は前のページに依存するため順番に生成し、
+# 画像プロンプトと画像は本文ができたページから並行して生成する
+# outline モードでは全ページの本文を1回で生成し、全ページの画像生成を同時に始める
+# on_page_ready を渡すと、本文と画像が揃ったページから順次 (ページ番号, 本文, 画像URL) で呼び出す
+async def generate_full_story_and_images_async(main_character, main_character_name, theme, sub_characters, storyline, target_age, num_pages, on_page_ready=None, story_mode=None, context_token_budget=CONTEXT_TOKEN_BUDGET):
+    story_mode = story_mode or STORY_MODE
     full_story = []
-    image_urls = []
-
-    for page_number in range(1, num_pages + 1):
-        print(f"Generating story for page {page_number}...")
-        page_story = generate_page_story(
-            main_character=main_character,
-            main_character_name=main_character_name,
-            theme=theme,
-            sub_characters=sub_characters,
-            storyline=storyline,
-            target_age=target_age,
-            page_number=page_number,
-            total_pages=num_pages,
-            previous_content="\n".join(full_story)
-        )
-        full_story.append(page_story)
+    image_tasks = []
 
-        print(f"Generating image prompt for page {page_number}...")
-        image_prompt = generate_image_prompt_from_story(
-            story=page_story,
+    async def generate_page_image_and_notify(page_number, page_story):
+        image_url = await generate_page_image_async(
+            page_story=page_story,
             main_character=main_character_name,
             theme=theme,
             sub_characters=sub_characters
         )
+        if on_page_ready:
+            on_page_ready(page_number, page_story, image_url)
+        return image_url
+
+    try:
+        if story_mode == "outline":
+            print(f"Generating story for all {num_pages} pages...")
+            try:
+                full_story = await generate_book_pages_async(
+                    main_character=main_character,
+                    main_character_name=main_character_name,
+                    theme=theme,
+                    sub_characters=sub_characters,
+                    storyline=storyline,
+                    target_age=target_age,
+                    total_pages=num_pages
+                )
+            except ValueError as e:
+                # ページ数が合わない・JSONが壊れている場合は1ページずつの生成に切り替える
+                print(f"Warning: Failed to generate all pages at once, falling back to sequential mode: {e}")
+                story_mode = "sequential"
+            else:
+                print("Generating images for all pages in background...")
+                for page_number, page_story in enumerate(full_story, 1):
+                    image_tasks.append(asyncio.create_task(generate_page_image_and_notify(page_number, page_story)))
+
+        if story_mode != "outline":
+            # これまでのストーリーは「あらすじ + 直前のページ」にまとめてトークン数を抑える
+            context = StoryContext(summarize=summarize_story_async, token_budget=context_token_budget)
+
+            for page_number in range(1, num_pages + 1):
+                print(f"Generating story for page {page_number}...")
+                page_story = await generate_page_story_async(
+                    main_character=main_character,
+                    main_character_name=main_character_name,
+                    theme=theme,
+                    sub_characters=sub_characters,
+                    storyline=storyline,
+                    target_age=target_age,
+                    page_number=page_number,
+                    total_pages=num_pages,
+                    previous_content=await context.next_context()
+                )
+                full_story.append(page_story)
+
+                # 画像生成を先に始めてから、ページを文脈に追加する（要約は次のページの生成時に行う）
+                print(f"Generating image for page {page_number} in background...")
+                image_tasks.append(asyncio.create_task(generate_page_image_and_notify(page_number, page_story)))
+                context.add_page(page_story)
+
+            print(f"Story context tokens: {context.report()}")
+
+        # 全ページの画像が揃うのを待つ（ページ順を保持）
+        image_urls = await asyncio.gather(*image_tasks)
+    except BaseException:
+        # 途中で失敗した場合は残りの画像生成を止める
+        for task in image_tasks:
+            task.cancel()
+        raise
+
+    return full_story, list(image_urls)
+
+def generate_full_story_and_images(main_character, main_character_name, theme, sub_characters, storyline, target_age, num_pages, story_mode=None):
+    return run_sync(generate_full_story_and_images_async(
+        main_character, main_character_name, theme, sub_characters, storyline, target_age, num_pages,
+        story_mode=story_mode
+    ))
 
-        print("Generating image...")
-        image_url = generate_image(image_prompt)
-        image_urls.append(image_url)
+# ページ単位のストリーミング生成
+# 完成したページから (ページ番号, 本文, 画像URL) を yield する（ページ番号順とは限らない）
+def iter_story_and_images(main_character, main_character_name, theme, sub_characters, storyline, target_age, num_pages, story_mode=None):
+    finished_pages = queue.Queue()
+    future = submit(generate_full_story_and_images_async(
+        main_character, main_character_name, theme, sub_characters, storyline, target_age, num_pages,
+        on_page_ready=lambda *page: finished_pages.put(page),
+        story_mode=story_mode
+    ))
+    future.add_done_callback(lambda _: finished_pages.put(None))
 
-    return full_story, image_urls
+    try:
+        while True:
+            page = finished_pages.get()
+            if page is None:
+                break
+            yield page
+        # 生成中の例外はここで呼び出し元に伝える
+        future.result()
+    finally:
+        if not future.done():
+            future.cancel()
@@ -0,0 +1,86 @@
+import os
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 「これまでのストーリー」に渡す文脈のトークン上限
+# 通常の5ページの絵本（1ページ最大100文字）では要約が発生しない大きさにしている
+CONTEXT_TOKEN_BUDGET = int(os.getenv("EHON_CONTEXT_TOKEN_BUDGET", "1500"))
+
+_encodings = {}
+
+# トークン数を数える（tiktokenが無い環境では文字数で概算）
+def count_tokens(text, model="gpt-4"):
+    if not text:
+        return 0
+    if tiktoken is None:
+        return len(text)
+
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return len(_encodings[model].encode(text))
+
+
+# ストーリーの文脈管理
+# 古いページは要約（あらすじ）に畳み込み、直前のページだけを原文のまま残すことで
+# ページ数が増えても1ページあたりのプロンプトが一定のトークン数に収まるようにする
+class StoryContext:
+    def __init__(self, summarize, token_budget=CONTEXT_TOKEN_BUDGET, model="gpt-4"):
+        # summarize: (これまでの要約, 畳み込むページのリスト, 最大トークン数) を受け取り新しい要約を返すコルーチン関数
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.model = model
+
+        self.summary = ""
+        self.pages = []        # まだ要約に畳み込んでいないページ
+        self.all_pages = []    # 比較用に全ページを保持
+
+        # トークン数の集計
+        self.context_tokens = 0        # 実際に送った文脈のトークン数（累計）
+        self.full_history_tokens = 0   # 全ページをそのまま送った場合のトークン数（累計）
+        self.summary_calls = 0
+        self.summary_tokens = 0        # 要約リクエストで送ったトークン数（累計）
+
+    # 次のページ生成に渡す文脈
+    def render(self):
+        if not self.summary:
+            return "\n".join(self.pages)
+        return f"これまでのあらすじ:\n{self.summary}\n\n直前のページ:\n" + "\n".join(self.pages)
+
+    # 次のページ生成に使う文脈を取得し、トークン数を記録する
+    # 上限を超えていれば、このときに直前のページ以外を要約に畳み込む
+    # （要約は次のページが必要になるまで行わないため、最後のページの後には要約しない）
+    async def next_context(self):
+        if len(self.pages) >= 2 and count_tokens(self.render(), self.model) > self.token_budget:
+            older_pages = self.pages[:-1]
+            self.summary_calls += 1
+            self.summary_tokens += count_tokens(self.summary + "\n".join(older_pages), self.model)
+            self.summary = await self.summarize(self.summary, older_pages, self.token_budget // 2)
+            self.pages = self.pages[-1:]
+
+        context = self.render()
+        self.context_tokens += count_tokens(context, self.model)
+        self.full_history_tokens += count_tokens("\n".join(self.all_pages), self.model)
+        return context
+
+    # 生成したページを追加する
+    def add_page(self, page_story):
+        self.pages.append(page_story)
+        self.all_pages.append(page_story)
+
+    # トークン数のレポート
+    def report(self):
+        return {
+            "pages": len(self.all_pages),
+            "token_budget": self.token_budget,
+            "context_tokens": self.context_tokens,
+            "full_history_tokens": self.full_history_tokens,
+            "saved_tokens": self.full_history_tokens - self.context_tokens - self.summary_tokens,
+            "summary_calls": self.summary_calls,
+            "summary_tokens": self.summary_tokens,
+        }
@@ -0,0 +1,60 @@
+import time
+import pytest
+
+pytest.importorskip("gspread")
+
+import write_behind
+from storage import SqliteStorage
+
+class FailingStorage(SqliteStorage):
+    def __init__(self):
+        super().__init__(":memory:")
+        self.attempts = 0
+
+    def append_book_pages(self, rows):
+        self.attempts += 1
+        raise RuntimeError("quota exceeded")
+
+def test_failing_backend_is_retried_at_backoff_rate(tmp_path, monkeypatch):
+    monkeypatch.setattr(write_behind, "RETRY_INITIAL_DELAY", 0.1)
+    monkeypatch.setattr(write_behind, "RETRY_MAX_DELAY", 0.1)
+    backend = FailingStorage()
+    storage = write_behind.WriteBehindStorage(backend, tmp_path / "journal.sqlite3")
+
+    storage.append_book_pages([["Ehon-00001", 1, "story", "https://example.com/1.png"]])
+    # 失敗中に追記・flush() があっても再試行の間隔は変わらない
+    deadline = time.monotonic() + 0.5
+    while time.monotonic() < deadline:
+        storage.append_book_pages([["Ehon-00002", 1, "story", "https://example.com/2.png"]])
+        storage.flush(timeout=0.01)
+        time.sleep(0.01)
+
+    # 0.5秒間に0.1秒間隔なら最大6回程度
+    assert 1 <= backend.attempts <= 7
+    assert storage.pending_count() > 0
+
+class PartlyFailingStorage(SqliteStorage):
+    def __init__(self, failing_book_id):
+        super().__init__(":memory:")
+        self.failing_book_id = failing_book_id
+
+    def append_book_pages(self, rows):
+        if rows[0][0] == self.failing_book_id:
+            raise RuntimeError("worksheet not found")
+        super().append_book_pages(rows)
+
+def test_failing_entry_does_not_block_other_books(tmp_path, monkeypatch):
+    monkeypatch.setattr(write_behind, "RETRY_INITIAL_DELAY", 0.01)
+    monkeypatch.setattr(write_behind, "RETRY_MAX_DELAY", 0.01)
+    monkeypatch.setattr(write_behind, "MAX_ATTEMPTS", 3)
+    backend = PartlyFailingStorage("Ehon-00001")
+    storage = write_behind.WriteBehindStorage(backend, tmp_path / "journal.sqlite3")
+
+    storage.append_book_pages([["Ehon-00001", 1, "story", "https://example.com/1.png"]])
+    storage.append_book_pages([["Ehon-00002", 1, "story", "https://example.com/2.png"]])
+
+    assert storage.flush(timeout=5)
+    assert backend.get_book_pages("Ehon-00002")
+    # 書き込めなかったページは dead_letter に残り、読み出すことはできる
+    assert storage.dead_letter_count() == 1
+    assert storage.get_book_pages("Ehon-00001")
@@ -0,0 +1,152 @@
+import threading
+import spacy
+from concurrent.futures import ThreadPoolExecutor
+from deep_translator import GoogleTranslator
+from cache import SqliteCache, make_cache_key
+from model_assets import SPACY_MODEL_DIR
+
+# spaCyによる名詞抽出
+# モデルはリポジトリ同梱のものをプロセス全体で1回だけロードし、全セッションで使い回す
+
+# 品詞（token.pos_）の判定に不要なコンポーネント
+# 名詞抽出には tok2vec / tagger / attribute_ruler だけを使う
+SPACY_EXCLUDE = ["parser", "ner", "lemmatizer", "senter"]
+
+# 翻訳で同時に送るリクエスト数
+TRANSLATION_MAX_WORKERS = 4
+
+# 翻訳結果の永続キャッシュ（英単語 → 訳語）
+translation_cache = SqliteCache("translations", max_entries=50000)
+
+# よく出る画像ラベル・名詞の訳語（ネットワークを使わずに返す）
+GLOSSARY_JA = {
+    "animal": "動物",
+    "art": "アート",
+    "ball": "ボール",
+    "balloon": "風船",
+    "bear": "クマ",
+    "bird": "鳥",
+    "boat": "ボート",
+    "boy": "男の子",
+    "bridge": "橋",
+    "butterfly": "チョウ",
+    "car": "車",
+    "cartoon": "まんが",
+    "cat": "ネコ",
+    "child": "子ども",
+    "child art": "子どもの絵",
+    "circle": "丸",
+    "cloud": "雲",
+    "colorfulness": "カラフル",
+    "crayon": "クレヨン",
+    "dinosaur": "恐竜",
+    "dog": "イヌ",
+    "door": "ドア",
+    "drawing": "絵",
+    "eye": "目",
+    "face": "顔",
+    "fictional character": "キャラクター",
+    "fish": "魚",
+    "flower": "花",
+    "fruit": "くだもの",
+    "garden": "庭",
+    "girl": "女の子",
+    "grass": "草",
+    "happy": "しあわせ",
+    "heart": "ハート",
+    "horse": "ウマ",
+    "house": "家",
+    "illustration": "イラスト",
+    "insect": "虫",
+    "leaf": "葉っぱ",
+    "line art": "線画",
+    "mammal": "哺乳類",
+    "moon": "月",
+    "mountain": "山",
+    "organism": "生き物",
+    "painting": "絵画",
+    "paper": "紙",
+    "park": "公園",
+    "pattern": "もよう",
+    "person": "人",
+    "petal": "花びら",
+    "picture": "絵",
+    "plant": "植物",
+    "rabbit": "ウサギ",
+    "rainbow": "虹",
+    "river": "川",
+    "sea": "海",
+    "sketch": "スケッチ",
+    "sky": "空",
+    "smile": "笑顔",
+    "snow": "雪",
+    "star": "星",
+    "sun": "太陽",
+    "toy": "おもちゃ",
+    "train": "電車",
+    "tree": "木",
+    "visual arts": "美術",
+    "water": "水",
+    "whiskers": "ひげ",
+}
+
+_nlp = None
+_nlp_lock = threading.Lock()
+_warm_up_thread = None
+_warm_up_lock = threading.Lock()
+
+# spaCyモデルを取得（初回のみロード）
+def get_nlp():
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            _nlp = spacy.load(SPACY_MODEL_DIR, exclude=SPACY_EXCLUDE)
+        return _nlp
+
+# 複数の文章から名詞をまとめて抽出（nlp.pipe で1回の処理にまとめる）
+def extract_nouns_batch(texts, batch_size=32):
+    nlp = get_nlp()
+    return [
+        [token.text for token in doc if token.pos_ == "NOUN"]
+        for doc in nlp.pipe(texts, batch_size=batch_size)
+    ]
+
+# 単語をまとめて翻訳
+# 用語辞書 → 永続キャッシュの順に探し、見つからない単語だけを並行して翻訳する
+def translate_terms(words, target_language="ja"):
+    translations = {}
+    missing = []
+    for word in dict.fromkeys(words):
+        term = word.strip().lower()
+        if target_language == "ja" and term in GLOSSARY_JA:
+            translations[word] = GLOSSARY_JA[term]
+            continue
+
+        cached = translation_cache.get(make_cache_key(target_language, term))
+        if cached is not None:
+            translations[word] = cached
+        else:
+            missing.append(word)
+
+    if missing:
+        def translate(word):
+            return GoogleTranslator(source="auto", target=target_language).translate(word)
+
+        with ThreadPoolExecutor(max_workers=min(TRANSLATION_MAX_WORKERS, len(missing))) as executor:
+            for word, translated in zip(missing, executor.map(translate, missing)):
+                translations[word] = translated
+                translation_cache.set(make_cache_key(target_language, word.strip().lower()), translated)
+
+    return [translations[word] for word in words]
+
+def is_ready():
+    return _nlp is not None
+
+# バックグラウンドでモデルのロードを開始（何度呼んでも1回だけ実行）
+def start_warm_up():
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=get_nlp, name="spacy-warm-up", daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
@@ -0,0 +1,50 @@
+import io
+from PIL import ImageOps
+from google.cloud import vision
+from google_clients import get_clients
+
+# Vision AIによるラベル抽出
+# クライアント（gRPCチャネル）はプロセス全体で1つを使い回し、
+# 画像は長辺を制限したJPEGに縮小してから送る
+
+VISION_MAX_EDGE = 1024  # 送信する画像の長辺の上限（px）
+VISION_MAX_ORIGINAL_BYTES = 512 * 1024  # これ以下の元ファイルはそのまま送る
+VISION_JPEG_QUALITY = 85
+VISION_MIN_SCORE = 0.8
+
+# クライアントは google_clients で認証情報とともにプロセス内で使い回す
+def get_vision_client(service_account_info):
+    return get_clients(service_account_info).vision_client()
+
+# Vision AIへ送る画像のバイト列
+# 元ファイルが十分小さければそのまま使い、そうでなければ縮小したJPEGに変換する
+# image: 元ファイルをデコードした画像（そのまま送れるかの判定に使う）
+# oriented: 向きを補正済みのRGB画像（あれば向きの補正・RGBへの変換をやり直さずに縮小する）
+def encode_for_vision(image, original_bytes=None, oriented=None):
+    if (
+        original_bytes
+        and len(original_bytes) <= VISION_MAX_ORIGINAL_BYTES
+        and max(image.size) <= VISION_MAX_EDGE
+        and image.format in ("JPEG", "PNG")
+        and image.getexif().get(0x0112, 1) == 1  # EXIFの回転指定がないもの
+    ):
+        return original_bytes
+
+    if oriented is None:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE))
+    elif max(oriented.size) > VISION_MAX_EDGE:
+        image = ImageOps.contain(oriented, (VISION_MAX_EDGE, VISION_MAX_EDGE))
+    else:
+        image = oriented
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+# スコアが min_score 以上のラベルを抽出
+# content: encode_for_vision で作成した画像のバイト列
+def extract_labels(content, service_account_info, min_score=VISION_MIN_SCORE):
+    client = get_vision_client(service_account_info)
+
+    response = client.label_detection(image=vision.Image(content=content))
+    return [label.description for label in response.label_annotations if label.score >= min_score]
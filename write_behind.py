@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from storage import Storage
+
+# 絵本のページの書き込みを後回しにする保存先（write-behind）
+# ページはまずローカルのジャーナル（SQLite）に記録してすぐに戻り、
+# バックグラウンドのスレッドが実際の保存先（スプレッドシートなど）へ書き込む
+# 書き込みが終わるまでジャーナルに残すため、途中でプロセスが終了しても次回の起動時に書き込み直す
+# 何度書き込んでも失敗するものは dead_letter テーブルに移し、他の絵本の書き込みを止めないようにする
+#
+# EHON_WRITE_BEHIND=1 で有効にする
+
+WRITE_BEHIND = os.getenv("EHON_WRITE_BEHIND", "0") == "1"
+JOURNAL_PATH = Path(os.getenv("EHON_JOURNAL_PATH", "data/write_journal.sqlite3"))
+
+RETRY_INITIAL_DELAY = 1.0  # 秒
+RETRY_MAX_DELAY = 60.0  # 秒
+MAX_ATTEMPTS = int(os.getenv("EHON_WRITE_BEHIND_MAX_ATTEMPTS", "10"))
+
+class WriteBehindStorage(Storage):
+    def __init__(self, backend, journal_path=JOURNAL_PATH):
+        self.backend = backend
+
+        if str(journal_path) != ":memory:":
+            Path(journal_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(journal_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " book_id TEXT NOT NULL,"
+            " rows TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS journal_book_id ON journal (book_id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letter ("
+            " id INTEGER PRIMARY KEY,"
+            " book_id TEXT NOT NULL,"
+            " rows TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL,"
+            " last_error TEXT)"
+        )
+        # 前回のプロセスから残っているもの（書き込み済みかどうか分からない）
+        self._conn.execute("UPDATE journal SET attempts = attempts + 1 WHERE attempts = 0")
+        self._conn.commit()
+
+        self.flushed = 0
+        self.failures = 0
+        self._wake = threading.Event()
+        self._idle = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        self._wake.set()
+
+    def get_prompt_rows(self):
+        return self.backend.get_prompt_rows()
+
+    def append_story_elements(self, row):
+        self.backend.append_story_elements(row)
+
+    def next_book_id(self):
+        return self.backend.next_book_id()
+
+    # ジャーナルに記録してすぐに戻る（保存先への書き込みはバックグラウンドで行う）
+    def append_book_pages(self, rows):
+        if not rows:
+            return
+        rows = [list(row) for row in rows]
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO journal (book_id, rows, created_at) VALUES (?, ?, ?)",
+                (rows[0][0], json.dumps(rows, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+        self._wake.set()
+
+    # 書き込み待ち（または書き込めなかった）ページがあればそれを返す
+    def get_book_pages(self, book_id):
+        with self._lock:
+            pending = self._conn.execute(
+                "SELECT rows FROM ("
+                " SELECT id, rows FROM journal WHERE book_id = ?"
+                " UNION ALL SELECT id, rows FROM dead_letter WHERE book_id = ?"
+                ") ORDER BY id",
+                (book_id, book_id)
+            ).fetchall()
+        if pending:
+            return [
+                [str(value) if value is not None else "" for value in row]
+                for (rows,) in pending for row in json.loads(rows)
+            ]
+        return self.backend.get_book_pages(book_id)
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+
+    def dead_letter_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+
+    # 書き込み待ちがなくなるまで待つ（終わったら True）
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._wake.set()
+        with self._idle:
+            while self._conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _write_entry(self, book_id, rows, attempts):
+        # 失敗した書き込みや前回のプロセスの書き込みは、実際には保存されている場合があるので確認してから書く
+        if attempts and self.backend.get_book_pages(book_id):
+            return
+        self.backend.append_book_pages(rows)
+
+    def _run(self):
+        delay = RETRY_INITIAL_DELAY
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+
+            while True:
+                # 失敗した回数が少ないものから書き込む（失敗し続けるものが他の絵本を止めないように）
+                with self._lock:
+                    entry = self._conn.execute(
+                        "SELECT id, book_id, rows, attempts FROM journal ORDER BY attempts, id LIMIT 1"
+                    ).fetchone()
+                if entry is None:
+                    with self._idle:
+                        self._idle.notify_all()
+                    break
+
+                entry_id, book_id, rows, attempts = entry
+                try:
+                    self._write_entry(book_id, json.loads(rows), attempts)
+                except Exception as e:
+                    print(f"Warning: Failed to write book {book_id} (attempt {attempts + 1}): {e}")
+                    self.failures += 1
+                    with self._lock:
+                        self._conn.execute(
+                            "UPDATE journal SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                            (str(e), entry_id)
+                        )
+                        if attempts + 1 >= MAX_ATTEMPTS:
+                            print(f"Warning: Giving up writing book {book_id} after {attempts + 1} attempts")
+                            self._conn.execute(
+                                "INSERT INTO dead_letter SELECT id, book_id, rows, created_at, attempts, last_error"
+                                " FROM journal WHERE id = ?",
+                                (entry_id,)
+                            )
+                            self._conn.execute("DELETE FROM journal WHERE id = ?", (entry_id,))
+                        self._conn.commit()
+                    # 時間をおいて再試行（新しい追記や flush() があっても待ち時間は短くしない）
+                    time.sleep(delay)
+                    delay = min(delay * 2, RETRY_MAX_DELAY)
+                    continue
+
+                delay = RETRY_INITIAL_DELAY
+                self.flushed += 1
+                with self._lock:
+                    self._conn.execute("DELETE FROM journal WHERE id = ?", (entry_id,))
+                    self._conn.commit()
+
+    def stats(self):
+        return {
+            "pending": self.pending_count(),
+            "dead_letter": self.dead_letter_count(),
+            "flushed": self.flushed,
+            "failures": self.failures,
+        }